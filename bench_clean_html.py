@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Порівняння швидкості очищення HTML: старий ланцюжок re.sub проти HtmlToText.
+
+Запуск:
+    python bench_clean_html.py                  # вбудований приклад звіту SAMPO
+    python bench_clean_html.py звіт1.html ...   # справжні HTML звіти з каси
+"""
+
+import re
+import sys
+import timeit
+
+from smtp_telegram_bridge import HtmlToText
+
+
+def legacy_clean_html(html_text):
+    """Попередня реалізація clean_html до виклику format_sampo_report"""
+    html_text = re.sub(r'<caption[^>]*>(.*?)</caption>', r'\n**\1**\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<tr[^>]*>', '\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</tr>', '', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<td[^>]*>', ' ', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</td>', ' |', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<th[^>]*>', ' **', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</th>', '** |', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<h[1-6][^>]*>', '\n**', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</h[1-6]>', '**\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<p[^>]*>', '\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</p>', '\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<br[^>]*/?>', '\n', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<b[^>]*>', '**', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</b>', '**', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<font[^>]*color[^>]*>', '*', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'</font>', '*', html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r'<[^>]+>', '', html_text)
+    html_text = html_text.replace('&nbsp;', ' ')
+    html_text = html_text.replace('&amp;', '&')
+    html_text = html_text.replace('&lt;', '<')
+    html_text = html_text.replace('&gt;', '>')
+    html_text = html_text.replace('&quot;', '"')
+    html_text = re.sub(r' +', ' ', html_text)
+    html_text = re.sub(r'\n\s*\n', '\n', html_text)
+    html_text = re.sub(r' *\| *\|', ' |', html_text)
+    return html_text
+
+
+def sample_report(products=60):
+    """Звіт у форматі SAMPO Reports (зведений звіт та звіт по товарах)"""
+    rows = "\n".join(
+        f'<tr><td>{i}</td><td>Товар №{i} &quot;Пакет&quot; 0,5&nbsp;л</td>'
+        f'<td>{i % 7 + 1},000</td><td>{i * 13.5:.2f}</td><td>{i * 2.25:.2f}</td></tr>'
+        for i in range(1, products + 1)
+    )
+    return f"""<html><head><meta charset="windows-1251"></head>
+<h2>SAMPO Reports</h2>
+<p>Отправка по команде пользователя.</p>
+<h3>Фильтр</h3>
+<p>Организации: ФОП Іваненко</p>
+<p>Склады: Магазин №1</p>
+<h3>Сводный отчет</h3>
+<p>Период: 01.09.2025 - 01.09.2025</p>
+<table border="1"><caption>ПРОДАЖИ</caption>
+<tr><td>Сумма</td><td>12&nbsp;345,67</td></tr>
+<tr><td>Скидка</td><td><font color="red">123,45</font></td></tr>
+<tr><td>Прибыль</td><td>2&nbsp;345,00</td></tr>
+<tr><td>К-во чеков</td><td>87</td></tr>
+<tr><td>Средний чек</td><td>141,90</td></tr>
+</table>
+<table border="1"><caption>ВОЗВРАТЫ</caption>
+<tr><td>Сумма</td><td>0,00</td></tr>
+<tr><td>Убыток</td><td>0,00</td></tr>
+</table>
+<h3>Отчет по товарам</h3>
+<table border="1">
+<tr><th>№</th><th>Имя</th><th>Кол-во</th><th>Стоимость</th><th>Прибыль</th></tr>
+{rows}
+</table>
+</html>
+"""
+
+
+def main():
+    if len(sys.argv) > 1:
+        reports = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            try:
+                reports.append((path, raw.decode('utf-8')))
+            except UnicodeDecodeError:
+                reports.append((path, raw.decode('windows-1251', errors='replace')))
+    else:
+        reports = [(f"приклад SAMPO, {n} товарів", sample_report(n)) for n in (10, 60, 500)]
+
+    converter = HtmlToText()
+
+    for name, report in reports:
+        number = max(1, 200000 // len(report))
+        legacy = min(timeit.repeat(lambda: legacy_clean_html(report), number=number, repeat=5)) / number
+        current = min(timeit.repeat(lambda: converter.convert(report), number=number, repeat=5)) / number
+
+        same = legacy_clean_html(report) == converter.convert(report)
+
+        print(f"{name} ({len(report)} символів)")
+        print(f"  re.sub ланцюжок: {legacy * 1e6:9.1f} мкс")
+        print(f"  HtmlToText:      {current * 1e6:9.1f} мкс  (x{legacy / current:.1f})")
+        print(f"  результат однаковий: {'так' if same else 'ні'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,35 @@
 
 import socket
 import threading
-import email
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.parser import BytesParser
+from email.feedparser import BytesFeedParser
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 import json
 import os
 import tkinter as tk
 from tkinter import ttk, messagebox
 import base64
 import re
+import html
 import sys
+import sqlite3
+import time
+import random
+import argparse
+import tempfile
+import codecs
+import hashlib
+import csv
+import io
+import binascii
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
 
 # Получаем путь к директории где лежит исполняемый файл
 if hasattr(sys, 'frozen'):
@@ -23,23 +42,2142 @@ else:
     APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 CONFIG_FILE = os.path.join(APP_DIR, "smtp_config.json")
+SPOOL_FILE = os.path.join(APP_DIR, "smtp_spool.db")
+# Великі листи зберігаються окремими файлами поруч з чергою
+SPOOL_DIR = os.path.join(APP_DIR, "smtp_spool")
+# Дані звітів (підсумки та товари) для історії продажів
+REPORTS_FILE = os.path.join(APP_DIR, "smtp_reports.db")
+# Денні підсумки по складах між перезапусками
+AGGREGATES_FILE = os.path.join(APP_DIR, "smtp_aggregates.json")
+
+# Межі кошиків гістограм: тривалість у секундах та розмір у байтах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+class Histogram:
+    """Гістограма з фіксованими межами кошиків (le, як у Prometheus)"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+class MetricsRegistry:
+    """Лічильники, гістограми та датчики для сторінки /metrics у текстовому форматі Prometheus.
+    
+    Запис - це інкремент у словнику чи кошику під коротким lock (і нічого, поки сторінку
+    не ввімкнено); датчики (черги, сесії) обчислюються лише під час запиту сторінки.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # назва -> (тип, опис)
+        self.descriptions = {}
+        # (назва, мітки) -> значення / Histogram
+        self.counters = {}
+        self.histograms = {}
+        # назва -> функція, що повертає поточне значення
+        self.gauges = {}
+    
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+    
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        histogram.observe(value)
+    
+    def gauge(self, name, function):
+        """Датчик, значення якого читається під час запиту сторінки"""
+        self.gauges[name] = function
+    
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        escaped = (
+            (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+    
+    def render(self):
+        """Усі метрики в текстовому форматі Prometheus"""
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: str(item[0]))
+            histograms = sorted(self.histograms.items(), key=lambda item: str(item[0]))
+        series = {}
+        for (name, labels), value in counters:
+            series.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            counts, total = histogram.snapshot()
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {cumulative}")
+        for name, function in sorted(self.gauges.items()):
+            try:
+                series[name] = [f"{name} {function()}"]
+            except Exception:
+                pass
+        
+        output = []
+        for name in sorted(series):
+            kind, text = self.descriptions.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+METRICS = MetricsRegistry()
+METRICS.describe("smtp_connections_total", "counter", "SMTP connections by result (accepted, rejected)")
+METRICS.describe("smtp_session_duration_seconds", "histogram", "SMTP session duration")
+METRICS.describe("smtp_messages_total", "counter", "Received messages by result (accepted, oversized, failed)")
+METRICS.describe("smtp_message_size_bytes", "histogram", "Size of received DATA/BDAT messages")
+METRICS.describe("report_stage_duration_seconds", "histogram",
+                 "Pipeline stage duration (normalize - HTML cleanup, format - SAMPO formatting)")
+METRICS.describe("reports_total", "counter", "Reports by outcome (delivered, retry, dead, duplicate)")
+METRICS.describe("telegram_requests_total", "counter", "Telegram Bot API calls by method and HTTP status")
+METRICS.describe("telegram_request_duration_seconds", "histogram", "Telegram Bot API call duration")
+METRICS.describe("errors_total", "counter", "Errors handled without stopping the bridge, by place")
+METRICS.describe("smtp_active_sessions", "gauge", "Open SMTP sessions")
+METRICS.describe("spool_pending_messages", "gauge", "Messages waiting in the delivery spool")
+METRICS.describe("telegram_queue_depth", "gauge", "Reports waiting in per-chat delivery queues")
+METRICS.describe("dedup_duplicates_total", "counter", "Reports dropped as retransmitted duplicates")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Сторінка /metrics для Prometheus"""
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class DeliverySpool:
+    """Черга листів на диску (SQLite WAL): лист записується до відповіді 250"""
+    def __init__(self, path=SPOOL_FILE):
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "received_at REAL NOT NULL, "
+            "mail_from TEXT NOT NULL, "
+            "rcpt_to TEXT NOT NULL, "
+            "data BLOB NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL DEFAULT 0, "
+            "last_error TEXT, "
+            "path TEXT, "
+            "delivered TEXT NOT NULL DEFAULT '[]', "
+            "progress TEXT NOT NULL DEFAULT '{}')"
+        )
+        # Черга, створена попередньою версією, не має полів для повторів
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(messages)")]
+        for column, definition in [("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                                   ("next_attempt", "REAL NOT NULL DEFAULT 0"),
+                                   ("last_error", "TEXT"),
+                                   ("path", "TEXT"),
+                                   ("delivered", "TEXT NOT NULL DEFAULT '[]'"),
+                                   ("progress", "TEXT NOT NULL DEFAULT '{}'")]:
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {definition}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_status ON messages (status, next_attempt, id)")
+        # Хеші вже оброблених звітів для відкидання повторів після перезапуску
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "digest TEXT PRIMARY KEY, "
+            "msg_id INTEGER, "
+            "seen_at REAL NOT NULL)"
+        )
+        # Листи, доставка яких перервалась разом з процесом, повертаємо в чергу
+        self.conn.execute("UPDATE messages SET status = 'pending' WHERE status = 'sending'")
+    
+    def enqueue(self, data, mail_from, rcpt_to, path=None):
+        """Збереження листа в черзі, повертає його id (великий лист - шлях до файлу в path)"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO messages (received_at, mail_from, rcpt_to, data, path) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (time.time(), mail_from, json.dumps(rcpt_to), data or b"", path)
+            )
+            self.available.notify()
+            return cursor.lastrowid
+    
+    def claim(self, timeout=1.0):
+        """Взяти наступний лист на доставку або None, якщо черга порожня"""
+        with self.lock:
+            row = self._next_pending()
+            if row is None:
+                self.available.wait(timeout)
+                row = self._next_pending()
+            if row is None:
+                return None
+            msg_id, mail_from, rcpt_to, data, attempts, path, delivered, progress = row
+            self.conn.execute("UPDATE messages SET status = 'sending' WHERE id = ?", (msg_id,))
+            return (msg_id, bytes(data), mail_from, json.loads(rcpt_to), attempts, path,
+                    json.loads(delivered), json.loads(progress))
+    
+    def _next_pending(self):
+        return self.conn.execute(
+            "SELECT id, mail_from, rcpt_to, data, attempts, path, delivered, progress FROM messages "
+            "WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt, id LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+    
+    def complete(self, msg_id):
+        """Лист доставлено - видаляємо з черги"""
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM messages WHERE id = ?", (msg_id,)).fetchone()
+            self.conn.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+        if row and row[0]:
+            try:
+                os.remove(row[0])
+            except OSError:
+                pass
+    
+    def mark_delivered(self, msg_id, destination):
+        """Лист доставлено в один з чатів; при повторі цей чат пропускається"""
+        with self.lock:
+            row = self.conn.execute("SELECT delivered FROM messages WHERE id = ?", (msg_id,)).fetchone()
+            if row is None:
+                return
+            delivered = json.loads(row[0])
+            if destination not in delivered:
+                delivered.append(destination)
+                self.conn.execute(
+                    "UPDATE messages SET delivered = ? WHERE id = ?",
+                    (json.dumps(delivered), msg_id)
+                )
+    
+    def mark_progress(self, msg_id, destination, sent, total):
+        """Відправлено sent з total частин звіту в чат; повтор продовжить з наступної частини"""
+        with self.lock:
+            row = self.conn.execute("SELECT progress FROM messages WHERE id = ?", (msg_id,)).fetchone()
+            if row is None:
+                return
+            progress = json.loads(row[0])
+            progress[destination] = [sent, total]
+            self.conn.execute(
+                "UPDATE messages SET progress = ? WHERE id = ?",
+                (json.dumps(progress), msg_id)
+            )
+    
+    def retry(self, msg_id, error, delay):
+        """Невдала спроба: повертаємо лист у чергу через delay секунд"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE messages SET status = 'pending', attempts = attempts + 1, "
+                "next_attempt = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, msg_id)
+            )
+    
+    def dead(self, msg_id, error):
+        """Спроби вичерпано: переносимо лист до недоставлених"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE messages SET status = 'dead', attempts = attempts + 1, last_error = ? "
+                "WHERE id = ?",
+                (error, msg_id)
+            )
+    
+    def dead_letters(self):
+        """Список недоставлених листів: (id, час отримання, відправник, спроби, помилка)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, received_at, mail_from, attempts, last_error FROM messages "
+                "WHERE status = 'dead' ORDER BY id"
+            ).fetchall()
+    
+    def replay(self, msg_ids=None):
+        """Повернення недоставлених листів у чергу, повертає їх кількість"""
+        with self.lock:
+            if msg_ids:
+                placeholders = ",".join("?" * len(msg_ids))
+                cursor = self.conn.execute(
+                    "UPDATE messages SET status = 'pending', attempts = 0, next_attempt = 0 "
+                    f"WHERE status = 'dead' AND id IN ({placeholders})",
+                    list(msg_ids)
+                )
+            else:
+                cursor = self.conn.execute(
+                    "UPDATE messages SET status = 'pending', attempts = 0, next_attempt = 0 "
+                    "WHERE status = 'dead'"
+                )
+            self.available.notify_all()
+            return cursor.rowcount
+    
+    def pending_count(self):
+        """Кількість листів, що очікують доставки"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE status IN ('pending', 'sending')"
+            ).fetchone()[0]
+    
+    def wakeup(self):
+        """Розбудити всі потоки доставки (при зупинці)"""
+        with self.lock:
+            self.available.notify_all()
+    
+    def load_seen(self, since):
+        """Хеші звітів, оброблених після since: (хеш, id листа, час); старіші видаляються"""
+        with self.lock:
+            self.conn.execute("DELETE FROM seen WHERE seen_at < ?", (since,))
+            return self.conn.execute(
+                "SELECT digest, msg_id, seen_at FROM seen ORDER BY seen_at"
+            ).fetchall()
+    
+    def remember_seen(self, digest, msg_id, seen_at):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO seen (digest, msg_id, seen_at) VALUES (?, ?, ?)",
+                (digest, msg_id, seen_at)
+            )
+    
+    def forget_seen(self, msg_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM seen WHERE msg_id = ?", (msg_id,))
+
+DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+
+def period_dates(period):
+    """Перша та остання дата періоду "01.09.2025 - 02.09.2025" у форматі ISO (або None)"""
+    dates = [f"{year}-{int(month):02d}-{int(day):02d}" for day, month, year in DATE_RE.findall(period or "")]
+    if not dates:
+        return None, None
+    return dates[0], dates[-1]
+
+class ReportStore:
+    """Підсумки та товари звітів у SQLite (WAL) для запитів історії продажів"""
+    def __init__(self, path=REPORTS_FILE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS reports ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "digest TEXT UNIQUE, "
+            "spool_id INTEGER, "
+            "received_at REAL NOT NULL, "
+            "register TEXT NOT NULL, "
+            "organisation TEXT, "
+            "warehouse TEXT, "
+            "period_start TEXT, "
+            "period_end TEXT, "
+            "subject TEXT)"
+        )
+        self.migrate()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS totals ("
+            "report_id INTEGER NOT NULL, "
+            "section TEXT NOT NULL, "
+            "metric TEXT NOT NULL, "
+            "value REAL NOT NULL, "
+            "PRIMARY KEY (report_id, section, metric)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "report_id INTEGER NOT NULL, "
+            "num INTEGER, "
+            "name TEXT NOT NULL, "
+            "quantity REAL, "
+            "cost REAL, "
+            "profit REAL)"
+        )
+        # Запити йдуть по касі, складу та періоду
+        self.conn.execute("CREATE INDEX IF NOT EXISTS reports_register ON reports (register, period_start)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS reports_warehouse ON reports (warehouse, period_start)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS reports_period ON reports (period_start, warehouse)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_report ON items (report_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_name ON items (name, report_id)")
+    
+    def migrate(self):
+        """База попередньої версії: звіти були унікальні за id листа в черзі, який після очищення черги повторюється"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(reports)")]
+        if "digest" in columns:
+            return
+        names = ", ".join(columns)
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("ALTER TABLE reports RENAME TO reports_old")
+            self.conn.execute(
+                "CREATE TABLE reports ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "digest TEXT UNIQUE, "
+                "spool_id INTEGER, "
+                "received_at REAL NOT NULL, "
+                "register TEXT NOT NULL, "
+                "organisation TEXT, "
+                "warehouse TEXT, "
+                "period_start TEXT, "
+                "period_end TEXT, "
+                "subject TEXT)"
+            )
+            self.conn.execute(f"INSERT INTO reports ({names}) SELECT {names} FROM reports_old")
+            self.conn.execute("DROP TABLE reports_old")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+    
+    def add(self, figures, register, subject=None, digest=None, spool_id=None, received_at=None):
+        """Запис звіту однією транзакцією (товари - пакетною вставкою); None, якщо звіт вже збережено"""
+        fields = figures['fields']
+        period_start, period_end = period_dates(fields.get('period'))
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                # Повторна спроба доставки (чи повторно надісланий касою лист) не дублює дані:
+                # хеш вмісту, на відміну від id в черзі, не повторюється після очищення черги
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO reports (digest, spool_id, received_at, register, organisation, "
+                    "warehouse, period_start, period_end, subject) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (digest, spool_id, received_at or time.time(), register, fields.get('organisation'),
+                     fields.get('warehouse'), period_start, period_end, subject)
+                )
+                if cursor.rowcount == 0:
+                    self.conn.execute("ROLLBACK")
+                    return None
+                report_id = cursor.lastrowid
+                self.conn.executemany(
+                    "INSERT INTO totals (report_id, section, metric, value) VALUES (?, ?, ?, ?)",
+                    [(report_id, section, metric, value)
+                     for section, values in figures['totals'].items()
+                     for metric, value in values.items()]
+                )
+                self.conn.executemany(
+                    "INSERT INTO items (report_id, num, name, quantity, cost, profit) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(report_id,) + item for item in figures['items']]
+                )
+                self.conn.execute("COMMIT")
+                return report_id
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def daily_totals(self, since, until=None, warehouse=None, register=None):
+        """Підсумки по днях періоду та складах: [(день, організація, склад, розділ, показник, сума)]"""
+        query = (
+            "SELECT r.period_start, r.organisation, r.warehouse, t.section, t.metric, SUM(t.value) "
+            "FROM reports r JOIN totals t ON t.report_id = r.id "
+            "WHERE r.period_start >= ? AND r.period_start <= ?"
+        )
+        params = [since, until or since]
+        if warehouse is not None:
+            query += " AND r.warehouse = ?"
+            params.append(warehouse)
+        if register is not None:
+            query += " AND r.register = ?"
+            params.append(register)
+        query += (" GROUP BY r.period_start, r.organisation, r.warehouse, t.section, t.metric "
+                  "ORDER BY r.period_start, r.organisation, r.warehouse, t.section, t.metric")
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+    
+    def compare_days(self, day, other, warehouse=None):
+        """Порівняння двох днів: {(організація, склад, розділ, показник): (значення дня, значення іншого дня)}"""
+        result = {}
+        for index, date in enumerate((day, other)):
+            for _, organisation, store, section, metric, value in self.daily_totals(date, date, warehouse):
+                values = result.setdefault((organisation, store, section, metric), [0.0, 0.0])
+                values[index] = value
+        return {key: tuple(values) for key, values in result.items()}
+
+class DailyAggregates:
+    """Наростаючі підсумки по днях, організаціях і складах; звіт додається за O(1), без перерахунку"""
+    # Показник (розділ.показник) -> (emoji, назва) у підсумку дня
+    METRICS = (
+        ("sales.amount", "💵", "Продажі"),
+        ("sales.discount", "🏷️", "Знижки"),
+        ("sales.profit", "📈", "Прибуток"),
+        ("sales.receipts", "🧾", "Чеків"),
+        ("returns.amount", "📉", "Повернення"),
+        ("returns.loss", "📉", "Збиток"),
+    )
+    # Скільки пам'ятати хеші врахованих звітів (повтор доставки не додається вдруге)
+    SEEN_TTL = 2 * 24 * 3600
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        # день (ISO) -> {(організація, склад): {"reports": n, "розділ.показник": сума}}
+        self.days = {}
+        # Забрані для підсумку дні, відправку яких Telegram ще не підтвердив
+        self.sending = []
+        # хеш звіту -> час врахування
+        self.seen = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                # Непідтверджений підсумок (процес завершився до відправки) буде відправлено знову
+                for days in [state.get("days", {})] + state.get("sending", []):
+                    for day, stores in days.items():
+                        for organisation, warehouse, totals in stores:
+                            self.merge(day, (organisation, warehouse), totals)
+                self.seen = state.get("seen", {})
+            except Exception as e:
+                pass
+    
+    def merge(self, day, store, totals):
+        """Додавання показників до підсумку складу за день (викликається під lock або при завантаженні)"""
+        current = self.days.setdefault(day, {}).setdefault(store, {})
+        for name, value in totals.items():
+            current[name] = current.get(name, 0) + value
+    
+    def add(self, figures, key=None):
+        """Врахування звіту (ReportFormat.parse); False, якщо звіт з цим хешем вже враховано"""
+        fields = figures['fields']
+        day = period_dates(fields.get('period'))[0] or datetime.now().strftime('%Y-%m-%d')
+        store = (fields.get('organisation') or "", fields.get('warehouse') or "")
+        totals = {"reports": 1}
+        for section, values in figures['totals'].items():
+            for metric, value in values.items():
+                totals[f"{section}.{metric}"] = value
+        with self.lock:
+            if key is not None:
+                if key in self.seen:
+                    return False
+                self.seen[key] = time.time()
+            self.merge(day, store, totals)
+            self.dirty = True
+            return True
+    
+    def take(self, day):
+        """Забрати для відправки підсумки всіх днів до day включно (зберігаються до confirm)"""
+        with self.lock:
+            days = {d: self.days.pop(d) for d in sorted(self.days) if d <= day}
+            if days:
+                self.sending.append(days)
+                self.dirty = True
+            return days
+    
+    def confirm(self, days):
+        """Підсумок відправлено - забуваємо забрані дні"""
+        with self.lock:
+            self.sending = [batch for batch in self.sending if batch is not days]
+            self.dirty = True
+    
+    def restore(self, days):
+        """Повернення підсумків, які не вдалося відправити"""
+        with self.lock:
+            self.sending = [batch for batch in self.sending if batch is not days]
+            for day, stores in days.items():
+                for store, totals in stores.items():
+                    self.merge(day, store, totals)
+            self.dirty = True
+    
+    def checkpoint(self):
+        """Збереження стану у файл (через тимчасовий файл, щоб збій не пошкодив попередній)"""
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            expired = time.time() - self.SEEN_TTL
+            self.seen = {key: seen_at for key, seen_at in self.seen.items() if seen_at >= expired}
+            state = {
+                "days": self.dump(self.days),
+                "sending": [self.dump(days) for days in self.sending],
+                "seen": self.seen,
+            }
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+    
+    @staticmethod
+    def dump(days):
+        """Дні у вигляді для JSON: {день: [[організація, склад, показники]]}"""
+        return {day: [[organisation, warehouse, totals]
+                      for (organisation, warehouse), totals in stores.items()]
+                for day, stores in days.items()}
+
+class DuplicateCache:
+    """Хеші нормалізованих звітів за останні ttl секунд (LRU) для відкидання повторів від каси"""
+    def __init__(self, size=1024, ttl=600, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        # хеш -> (час, id листа в черзі)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        if store:
+            for digest, msg_id, seen_at in store.load_seen(time.time() - ttl)[-size:]:
+                self.entries[digest] = (seen_at, msg_id)
+    
+    def check(self, digest, owner=None):
+        """True, якщо такий звіт вже надходив іншим листом; інакше звіт запам'ятовується"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(digest)
+            # Повторна спроба доставки того ж листа з черги дублікатом не є
+            if entry and now - entry[0] < self.ttl and (owner is None or entry[1] != owner):
+                self.hits += 1
+                return True
+            self.entries[digest] = (now, owner)
+            self.entries.move_to_end(digest)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        if self.store:
+            self.store.remember_seen(digest, owner, now)
+        return False
+    
+    def forget(self, owner):
+        """Забути звіт листа, який не вдалося доставити, щоб повтор від каси не відкидався"""
+        with self.lock:
+            for digest in [digest for digest, entry in self.entries.items() if entry[1] == owner]:
+                del self.entries[digest]
+        if self.store:
+            self.store.forget_seen(owner)
+
+class TelegramDeliveryError(Exception):
+    """Telegram не прийняв повідомлення"""
+    def __init__(self, message, permanent=False, flood=False):
+        super().__init__(message)
+        # Постійна помилка (невірний токен, чат, розмітка) - повтор не допоможе
+        self.permanent = permanent
+        # 429: чат призупинено в TelegramRateLimiter, повтор - після паузи
+        self.flood = flood
+
+class TokenBucket:
+    """Відро токенів: rate токенів на секунду, не більше capacity підряд"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def delay(self, now):
+        """Скільки секунд чекати до наступного токена (0 - можна відправляти)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def block(self, now, seconds):
+        """Пауза після 429 від Telegram"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+class TelegramRateLimiter:
+    """Планувальник відправки з урахуванням лімітів Telegram (загальний та на чат)"""
+    def __init__(self, global_rate=30, chat_rate=1.0, group_rate=20 / 60):
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_buckets = {}
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Від'ємний chat_id - група або канал, для них ліміт значно нижчий
+            is_group = str(chat_id).startswith('-')
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 1 if is_group else max(1, rate))
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def acquire(self, chat_id=None):
+        """Очікування дозволу на відправку в чат"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.global_bucket.delay(now)
+                chat_bucket = None
+                if chat_id is not None:
+                    chat_bucket = self._chat_bucket(chat_id)
+                    wait = max(wait, chat_bucket.delay(now))
+                if wait <= 0:
+                    self.global_bucket.take()
+                    if chat_bucket:
+                        chat_bucket.take()
+                    return
+            time.sleep(wait)
+    
+    def delay(self, chat_id=None):
+        """Скільки секунд чекати до дозволу на відправку в чат (без очікування та без витрати токена)"""
+        with self.lock:
+            now = time.monotonic()
+            wait = self.global_bucket.delay(now)
+            if chat_id is not None:
+                wait = max(wait, self._chat_bucket(chat_id).delay(now))
+            return wait
+    
+    def retry_after(self, chat_id, seconds):
+        """Telegram повернув 429: призупиняємо чат (або всього бота) на retry_after"""
+        with self.lock:
+            now = time.monotonic()
+            if chat_id is not None:
+                self._chat_bucket(chat_id).block(now, seconds)
+            else:
+                self.global_bucket.block(now, seconds)
+
+class TelegramDocument:
+    """Файл для sendDocument; вміст віддається частинами і може читатися повторно"""
+    CHUNK_SIZE = 65536
+    
+    def __init__(self, filename, chunks, content_type='application/octet-stream', size=None):
+        self.filename = filename
+        # chunks() щоразу повертає новий ітератор байтів (для розміру, відправки та повторів)
+        self.chunks = chunks
+        self.content_type = content_type
+        self._size = size
+    
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sum(len(chunk) for chunk in self.chunks())
+        return self._size
+    
+    @classmethod
+    def from_text(cls, filename, text):
+        """Текстовий файл UTF-8, що кодується частинами"""
+        step = cls.CHUNK_SIZE
+        return cls(
+            filename,
+            lambda: (text[i:i + step].encode('utf-8') for i in range(0, len(text), step)),
+            'text/plain; charset=utf-8'
+        )
+    
+    @classmethod
+    def from_rows(cls, filename, rows):
+        """CSV (з BOM та ";" для Excel) з рядків таблиці; rows() повертає ітератор рядків"""
+        def chunks():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, delimiter=';')
+            buffer.write('\ufeff')
+            for row in rows():
+                writer.writerow(row)
+                if buffer.tell() >= cls.CHUNK_SIZE:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue().encode('utf-8')
+        return cls(filename, chunks, 'text/csv; charset=utf-8')
+    
+    @classmethod
+    def from_mime_part(cls, part, filename):
+        """Вкладення листа; base64 декодується частинами, без повної копії файлу в пам'яті"""
+        content_type = part.get_content_type()
+        payload = part.get_payload()
+        if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64' and isinstance(payload, str):
+            step = cls.CHUNK_SIZE
+            
+            def chunks():
+                rest = ''
+                for i in range(0, len(payload), step):
+                    piece = rest + ''.join(payload[i:i + step].split())
+                    cut = len(piece) - len(piece) % 4
+                    rest = piece[cut:]
+                    if cut:
+                        yield binascii.a2b_base64(piece[:cut])
+                if rest.strip('='):
+                    # Обрізаний кінець - доповнюємо, як це робить get_payload(decode=True)
+                    yield binascii.a2b_base64(rest + '=' * (-len(rest) % 4))
+            return cls(filename, chunks, content_type)
+        
+        data = part.get_payload(decode=True) or b''
+        view = memoryview(data)
+        return cls(
+            filename,
+            lambda: (view[i:i + cls.CHUNK_SIZE].tobytes() for i in range(0, len(view), cls.CHUNK_SIZE)),
+            content_type,
+            size=len(data)
+        )
+
+class MultipartStream:
+    """Тіло multipart/form-data, що формується під час читання (файли не копіюються в пам'ять цілком)"""
+    def __init__(self, fields, documents):
+        self.boundary = "smtp-telegram-" + os.urandom(12).hex()
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.segments = []
+        for name, value in fields.items():
+            self.segments.append(self.part_header(name) + str(value).encode('utf-8') + b"\r\n")
+        for name, document in documents.items():
+            self.segments.append(self.part_header(name, document.filename, document.content_type))
+            self.segments.append(document)
+            self.segments.append(b"\r\n")
+        self.segments.append(f"--{self.boundary}--\r\n".encode('ascii'))
+        # requests бере Content-Length з атрибута len
+        self.len = sum(len(segment) if isinstance(segment, bytes) else segment.size
+                       for segment in self.segments)
+        self.chunks = self.iterate()
+        self.buffer = bytearray()
+    
+    def part_header(self, name, filename=None, content_type=None):
+        disposition = f'form-data; name="{name}"'
+        if filename:
+            disposition += '; filename="%s"' % filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+        header = f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+        if content_type:
+            header += f"Content-Type: {content_type}\r\n"
+        return (header + "\r\n").encode('utf-8')
+    
+    def iterate(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from segment.chunks()
+    
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class TelegramClient:
+    """HTTP клієнт Telegram Bot API з пулом keep-alive з'єднань"""
+    def __init__(self, token, pool_size=8, connect_timeout=5, read_timeout=30,
+                 global_rate=30, chat_rate=1.0, group_rate=20 / 60, max_flood_retries=5):
+        self.token = token
+        self.base_url = f"https://api.telegram.org/bot{token}/"
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.limiter = TelegramRateLimiter(global_rate, chat_rate, group_rate)
+        self.max_flood_retries = max_flood_retries
+    
+    def call(self, method, data=None, timeout=None, documents=None, wait=True):
+        """Виклик методу Bot API через спільне з'єднання з дотриманням лімітів
+        
+        documents - {поле: TelegramDocument}; такі файли передаються потоком і
+        можуть бути відправлені повторно після 429. wait=False - одна спроба:
+        після 429 пауза чату запам'ятовується, а повтор виконує викликач.
+        """
+        chat_id = data.get('chat_id') if data else None
+        
+        for attempt in range(self.max_flood_retries + 1 if wait else 1):
+            self.limiter.acquire(chat_id)
+            started = time.perf_counter()
+            try:
+                response = self.post(method, data, timeout, documents)
+            except Exception:
+                METRICS.inc("telegram_requests_total", method=method, status="error")
+                METRICS.observe("telegram_request_duration_seconds", time.perf_counter() - started,
+                                method=method, status="error")
+                raise
+            METRICS.inc("telegram_requests_total", method=method, status=response.status_code)
+            METRICS.observe("telegram_request_duration_seconds", time.perf_counter() - started,
+                            method=method, status=response.status_code)
+            if response.status_code != 429:
+                return response
+            
+            self.limiter.retry_after(chat_id, self.parse_retry_after(response))
+        
+        return response
+    
+    def post(self, method, data, timeout, documents):
+        """Один HTTP запит до Bot API"""
+        if documents:
+            body = MultipartStream(data, documents)
+            return self.session.post(
+                self.base_url + method,
+                data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=timeout or self.timeout
+            )
+        return self.session.post(
+            self.base_url + method,
+            data=data,
+            timeout=timeout or self.timeout
+        )
+    
+    @staticmethod
+    def parse_retry_after(response):
+        """Секунди очікування з відповіді 429"""
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except Exception:
+            pass
+        try:
+            return float(response.headers.get('Retry-After', 1))
+        except Exception:
+            return 1.0
+    
+    def send_message(self, chat_id, text, parse_mode=None, timeout=None, wait=True):
+        """Відправка текстового повідомлення"""
+        payload = {
+            'chat_id': chat_id,
+            'text': text
+        }
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        return self.call("sendMessage", data=payload, timeout=timeout, wait=wait)
+    
+    def send_document(self, chat_id, document, caption=None, parse_mode=None, timeout=None, wait=True):
+        """Відправка файлу (TelegramDocument) потоком multipart"""
+        payload = {'chat_id': chat_id}
+        if caption:
+            payload['caption'] = caption
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        return self.call("sendDocument", data=payload, documents={'document': document}, timeout=timeout,
+                         wait=wait)
+    
+    def send_media_group(self, chat_id, documents, timeout=None, wait=True):
+        """Відправка 2-10 файлів одним альбомом (один виклик API)"""
+        files = {f"file{i}": document for i, document in enumerate(documents)}
+        media = [{'type': 'document', 'media': f"attach://{name}"} for name in files]
+        payload = {'chat_id': chat_id, 'media': json.dumps(media)}
+        return self.call("sendMediaGroup", data=payload, documents=files, timeout=timeout, wait=wait)
+
+_telegram_clients = {}
+_telegram_clients_lock = threading.Lock()
+
+def get_telegram_client(token, **options):
+    """Спільний клієнт для токена бота (один пул з'єднань та лімітів на всі потоки доставки)"""
+    with _telegram_clients_lock:
+        client = _telegram_clients.get(token)
+        if client is None:
+            client = TelegramClient(token, **options)
+            _telegram_clients[token] = client
+        return client
+
+class MessageRouter:
+    """Маршрути звітів: правила (одержувач, відправник, тема) -> чати (токен бота, chat_id).
+    
+    Адреси правил зводяться в словники (адреса або @домен -> правила), тож вибір маршрутів
+    не перебирає всі правила для кожного листа; перебираються лише шаблони тем.
+    """
+    CONDITIONS = ("recipient", "sender", "subject")
+    
+    def __init__(self, rules, default):
+        self.default = [default]
+        self.destinations = []
+        self.conditions = []
+        self.by_recipient = {}
+        self.by_sender = {}
+        # Правила без умов додають свої чати до кожного звіту
+        self.always = []
+        # (номер правила, скомпільований шаблон теми)
+        self.subjects = []
+        
+        for index, rule in enumerate(rules):
+            token = rule.get("token") or default[0]
+            self.destinations.append([(token, str(chat_id)) for chat_id in self.as_list(rule.get("chat_id"))])
+            self.conditions.append({name for name in self.CONDITIONS if rule.get(name)})
+            for address in self.as_list(rule.get("recipient")):
+                self.by_recipient.setdefault(address.lower(), []).append(index)
+            for address in self.as_list(rule.get("sender")):
+                self.by_sender.setdefault(address.lower(), []).append(index)
+            if rule.get("subject"):
+                # Кожен шаблон компілюється окремо: групи та зворотні посилання правила не змішуються
+                try:
+                    self.subjects.append((index, re.compile(rule["subject"], re.IGNORECASE)))
+                except re.error as e:
+                    raise re.error(f"маршрут {index + 1}: невірний шаблон теми {rule['subject']!r}: {e}")
+            if not self.conditions[index]:
+                self.always.append(index)
+    
+    @staticmethod
+    def as_list(value):
+        if not value:
+            return []
+        return value if isinstance(value, list) else [value]
+    
+    @staticmethod
+    def lookup(index, address):
+        """Правила для адреси: точний збіг та збіг за @доменом"""
+        address = address.lower()
+        rules = index.get(address, [])
+        if "@" in address:
+            rules = rules + index.get(address[address.index("@"):], [])
+        return rules
+    
+    def route(self, rcpt_to, mail_from, subject):
+        """Список (токен, chat_id) для листа; без жодного збігу - основний чат"""
+        satisfied = {index: set() for index in self.always}
+        for address in rcpt_to:
+            for index in self.lookup(self.by_recipient, address):
+                satisfied.setdefault(index, set()).add("recipient")
+        for index in self.lookup(self.by_sender, mail_from or ""):
+            satisfied.setdefault(index, set()).add("sender")
+        if subject:
+            for index, pattern in self.subjects:
+                if pattern.search(subject):
+                    satisfied.setdefault(index, set()).add("subject")
+        
+        destinations = []
+        for index in sorted(satisfied):
+            # Усі умови правила мають виконатись
+            if satisfied[index] >= self.conditions[index]:
+                for destination in self.destinations[index]:
+                    if destination not in destinations:
+                        destinations.append(destination)
+        return destinations or self.default
+
+class ChatDeliveryScheduler:
+    """Черга FIFO для кожного чату: частини звітів ідуть по порядку, різні чати - паралельно"""
+    def __init__(self, send, workers=8):
+        # send(чат, повідомлення, звіт або None) повертає ітератор кроків відправки звіту:
+        # кожен крок відправляє не більше однієї частини і видає паузу в секундах до наступного
+        self.send = send
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="telegram-chat")
+        self.queues = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, destination, messages, callback, report=None):
+        """Додати звіт у чергу чату; callback(помилка або None) викликається після відправки"""
+        with self.lock:
+            queue = self.queues.get(destination)
+            if queue is not None:
+                # Чат вже обслуговується - звіт буде відправлено після попередніх
+                queue.append([messages, callback, report, None])
+                return
+            self.queues[destination] = deque([[messages, callback, report, None]])
+        self.pool.submit(self.run, destination)
+    
+    def run(self, destination):
+        """Один крок відправки звіту з черги чату.
+        
+        Після кроку чат стає в кінець черги пулу, а чат, що чекає ліміту чи паузи після 429,
+        повертається в пул таймером - потік пулу не спить і не затримує інші чати.
+        """
+        with self.lock:
+            entry = self.queues[destination][0]
+        messages, callback, report, steps = entry
+        error = None
+        try:
+            if steps is None:
+                steps = entry[3] = self.send(destination, messages, report)
+            delay = next(steps)
+        except StopIteration:
+            pass
+        except Exception as e:
+            error = e
+        else:
+            self.resume(destination, delay)
+            return
+        try:
+            callback(error)
+        except Exception:
+            pass
+        
+        with self.lock:
+            queue = self.queues[destination]
+            queue.popleft()
+            if not queue:
+                del self.queues[destination]
+                return
+        self.resume(destination)
+    
+    def resume(self, destination, delay=0):
+        """Повернення чату в пул одразу або через delay секунд"""
+        if delay > 0:
+            timer = threading.Timer(delay, self.resume, (destination,))
+            timer.daemon = True
+            timer.start()
+            return
+        try:
+            self.pool.submit(self.run, destination)
+        except RuntimeError:
+            # Пул зупинено; недоставлені звіти залишаються в черзі на диску
+            pass
+    
+    def pending_count(self):
+        """Кількість звітів, що чекають відправки в усіх чатах"""
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+    
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+class SMTPLineBuffer:
+    """Буфер вхідних байтів SMTP: видає рядки незалежно від меж recv"""
+    def __init__(self, max_line=65536):
+        self.buffer = bytearray()
+        self.scan_from = 0
+        self.max_line = max_line
+    
+    def feed(self, data):
+        """Додавання отриманих байтів"""
+        self.buffer += data
+    
+    def next_line(self):
+        """Наступний рядок разом з CRLF або None, якщо рядок ще не отримано повністю"""
+        idx = self.buffer.find(b"\n", self.scan_from)
+        if idx < 0:
+            if len(self.buffer) >= self.max_line:
+                # Дуже довгий рядок без переносу віддаємо частинами, не розриваючи CRLF
+                end = len(self.buffer) - 1 if self.buffer.endswith(b"\r") else len(self.buffer)
+                return self._take(end)
+            self.scan_from = len(self.buffer)
+            return None
+        return self._take(idx + 1)
+    
+    def take(self, size):
+        """До size байтів сирих даних з буфера (для BDAT)"""
+        return self._take(min(size, len(self.buffer)))
+    
+    def _take(self, end):
+        line = bytes(self.buffer[:end])
+        # Видалення з початку bytearray не копіює решту буфера
+        del self.buffer[:end]
+        self.scan_from = 0
+        return line
+
+class MessageSink:
+    """Тіло листа: у пам'яті до memory_limit байтів, далі - у файлі на диску.
+    
+    Поки лист надходить, він одночасно розбирається BytesFeedParser (і після запису
+    у файл), тож після завершення DATA готовий MIME об'єкт є одразу. Лист, більший
+    за parse_limit, розбирається з файлу вже після DATA.
+    """
+    def __init__(self, memory_limit=1048576, spill_dir=None, parse_limit=10485760):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.parse_limit = parse_limit
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+        self.parser = BytesFeedParser(policy=policy.default)
+        self.message = None
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.file is None and len(self.buffer) + len(data) > self.memory_limit:
+            self.file = tempfile.NamedTemporaryFile(
+                dir=self.spill_dir, prefix="msg-", suffix=".eml", delete=False
+            )
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.parser is not None:
+            if self.size > self.parse_limit:
+                # Дерево MIME дуже великого листа не тримаємо в пам'яті сесії весь час прийому
+                self.parser = None
+            else:
+                self.parser.feed(data)
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.buffer += data
+    
+    def finish(self):
+        """Завершення запису: (bytes, None) для листа в пам'яті або (None, шлях) для файлу"""
+        if self.parser is not None:
+            try:
+                self.message = self.parser.close()
+            except Exception:
+                self.message = None
+            self.parser = None
+        if self.file is None:
+            return bytes(self.buffer), None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        path = self.file.name
+        self.file = None
+        return None, path
+    
+    def discard(self):
+        """Відмова від листа (RSET, перевищення розміру, розрив з'єднання)"""
+        self.buffer = bytearray()
+        self.parser = None
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+            self.file = None
+
+class SMTPSession:
+    """Стан однієї SMTP сесії (спільний для потокового та asyncio рушіїв)"""
+    def __init__(self, max_size=52428800, memory_limit=1048576, spill_dir=None, parse_limit=10485760):
+        self.max_size = max_size
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.parse_limit = parse_limit
+        self.auth_stage = None
+        self.in_data_mode = False
+        self.closing = False
+        self.sink = None
+        self.reset()
+    
+    def reset(self):
+        """Скидання поточної транзакції"""
+        if self.sink:
+            self.sink.discard()
+        # None - команду MAIL ще не прийнято (RCPT, DATA та BDAT отримують 503)
+        self.mail_from = None
+        self.rcpt_to = []
+        self.in_data_mode = False
+        self.sink = MessageSink(self.memory_limit, self.spill_dir, self.parse_limit)
+        self.oversized = False
+        self.at_line_start = True
+        self.bdat_remaining = None
+        self.bdat_size = 0
+        self.bdat_last = False
+        # Відповідь на фрагмент BDAT, байти якого дочитуються і відкидаються
+        self.bdat_rejected = None
+    
+    def start_bdat(self, size, last):
+        """Початок фрагмента BDAT (RFC 3030)"""
+        self.bdat_remaining = size
+        self.bdat_size = size
+        self.bdat_last = last
+    
+    def add_chunk(self, chunk):
+        """Додавання сирих байтів фрагмента BDAT (без dot-stuffing)"""
+        if not self.bdat_rejected:
+            self.write(chunk)
+        self.bdat_remaining -= len(chunk)
+    
+    def write(self, data):
+        """Запис у тіло листа з контролем ліміту SIZE"""
+        if self.oversized:
+            return
+        if self.sink.size + len(data) > self.max_size:
+            # Решту листа дочитуємо, але не зберігаємо; після завершення буде 552
+            self.oversized = True
+            self.sink.discard()
+            return
+        self.sink.write(data)
+    
+    def take_message(self):
+        """Забрати отримане тіло листа: (bytes, None, ...) або (None, шлях до файлу, ...)
+        
+        Третій елемент - розібраний під час прийому лист або None.
+        """
+        sink = self.sink
+        data, path = sink.finish()
+        self.sink = MessageSink(self.memory_limit, self.spill_dir, self.parse_limit)
+        return data, path, sink.message
+    
+    def start_data(self):
+        """Перехід у режим DATA"""
+        self.in_data_mode = True
+        self.at_line_start = True
+    
+    def is_data_end(self, line):
+        """Рядок з однієї крапки завершує DATA"""
+        return self.at_line_start and line in (b".\r\n", b".\n")
+    
+    def add_data_line(self, line):
+        """Додавання рядка тіла листа (з dot-unstuffing та нормалізацією CRLF)"""
+        if self.at_line_start and line.startswith(b"."):
+            line = line[1:]
+        
+        self.at_line_start = line.endswith(b"\n")
+        if line.endswith(b"\r\n"):
+            self.write(line[:-2] + b"\n")
+        else:
+            self.write(line)
+
+class CharsetDetector:
+    """Визначення кодування тіла листа з кешем вже визначених кодувань для кожної каси"""
+    # Однобайтові кодування, якими каси надсилають кирилицю
+    CANDIDATES = ('cp1251', 'koi8-u', 'cp1125')
+    # Приблизна частота кириличних літер (%) в українських та російських текстах; рахується
+    # по тексту в нижньому регістрі, бо між cp1251 і KOI8-U великі та малі літери міняються місцями
+    LETTER_WEIGHTS = {
+        'о': 11, 'а': 8, 'е': 8, 'и': 7, 'н': 7, 'т': 6, 'і': 5, 'р': 5, 'с': 5, 'в': 4.5,
+        'л': 4.4, 'к': 3.5, 'м': 3.2, 'д': 3, 'п': 2.8, 'у': 2.6, 'я': 2, 'ы': 1.9, 'ь': 1.7,
+        'г': 1.7, 'з': 1.6, 'б': 1.6, 'ч': 1.4, 'й': 1.2, 'х': 1, 'ж': 0.9, 'ш': 0.7, 'ю': 0.6,
+        'ї': 0.6, 'ц': 0.5, 'щ': 0.4, 'є': 0.4, 'э': 0.3, 'ф': 0.3, 'ё': 0.1, 'ґ': 0.05, 'ъ': 0.04,
+    }
+    SUSPICIOUS_RE = re.compile(r'[\x00-\x08\x0b\x0e-\x1f\x7f-\x9f\u2500-\u25ff\ufffd]')
+    # Велика літера посеред слова ("оПНДЮФХ") - ознака переставлених регістрів
+    MIXED_CASE_RE = re.compile(r'[а-яёіїєґ][А-ЯЁІЇЄҐ]')
+    PENALTY = 8
+    # Бали на літеру: правильне декодування дає ~4.5-6.5, помилкове - до ~4
+    PLAUSIBLE_RATE = 4.2
+    # Перевага заявленого в листі кодування (бали на літеру)
+    DECLARED_BONUS = 0.5
+    # Кешується лише впевнений результат: достатньо літер і відрив від другого варіанту
+    MIN_LETTERS = 16
+    MIN_MARGIN = 1.0
+    
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def decode(self, payload, declared=None, sender=None):
+        """Байти -> текст; однобайтове кодування береться з кешу каси, інакше визначається заново"""
+        if payload.isascii():
+            return payload.decode('ascii')
+        # Кириличний текст у cp1251 практично ніколи не є коректним UTF-8
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        
+        if sender:
+            with self.lock:
+                charset = self.cache.get(sender)
+                if charset:
+                    self.cache.move_to_end(sender)
+            if charset:
+                # Однобайтові кодування декодують майже будь-які байти, тому результат перевіряється
+                try:
+                    text = payload.decode(charset)
+                    if self.score(text)[0] >= self.PLAUSIBLE_RATE:
+                        return text
+                except UnicodeDecodeError:
+                    pass
+                with self.lock:
+                    self.cache.pop(sender, None)
+        
+        charset, confident = self.detect_single_byte(payload, declared)
+        if sender and confident:
+            with self.lock:
+                self.cache[sender] = charset
+                self.cache.move_to_end(sender)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return payload.decode(charset, errors='replace')
+    
+    def detect_single_byte(self, payload, declared=None):
+        """Вибір однобайтового кодування за оцінкою декодованого тексту: (кодування, впевненість)"""
+        candidates = list(self.CANDIDATES)
+        declared = self.normalize(declared)
+        if declared and declared != 'utf-8' and declared not in candidates:
+            candidates.insert(0, declared)
+        
+        results = []
+        for charset in candidates:
+            try:
+                text = payload.decode(charset)
+            except (UnicodeDecodeError, LookupError):
+                continue
+            rate, letters = self.score(text)
+            # Заявлене в листі кодування перемагає, якщо інше не набагато правдоподібніше
+            if charset == declared:
+                rate += self.DECLARED_BONUS
+            results.append((rate, letters, charset))
+        if not results:
+            return 'cp1251', False
+        
+        results.sort(key=lambda result: result[0], reverse=True)
+        rate, letters, best = results[0]
+        margin = rate - results[1][0] if len(results) > 1 else self.MIN_MARGIN
+        return best, letters >= self.MIN_LETTERS and margin >= self.MIN_MARGIN
+    
+    def score(self, text):
+        """Оцінка правдоподібності кириличного тексту: (бали на літеру, кількість літер)"""
+        lower = text.lower()
+        counts = [(lower.count(letter), weight) for letter, weight in self.LETTER_WEIGHTS.items()]
+        letters = sum(count for count, weight in counts)
+        total = sum(count * weight for count, weight in counts)
+        total -= self.PENALTY * (len(self.SUSPICIOUS_RE.findall(text)) + len(self.MIXED_CASE_RE.findall(text)))
+        return total / max(letters, 1), letters
+    
+    @staticmethod
+    def normalize(charset):
+        """Канонічна назва кодування (windows-1251 -> cp1251) або None для невідомих"""
+        if not charset:
+            return None
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            return None
+
+class HtmlToText:
+    """Перетворення HTML звіту в текст з Markdown розміткою за один прохід токенізатора"""
+    # Розбиття на текст та імена тегів; <!DOCTYPE>, <?xml?> потрапляють у групу як "!" / "?"
+    TAG_RE = re.compile(r'<(/?[a-zA-Z][a-zA-Z0-9]*|[!?])[^>]*>')
+    # Коментарі та вміст script/style видаляються лише якщо вони є в листі
+    IGNORED_RE = re.compile(r'<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+    FONT_RE = re.compile(r'<(/?)font\b([^>]*)>', re.IGNORECASE)
+    OTHER_ENTITY_RE = re.compile(r'&(?!amp;)[#a-zA-Z]')
+    # Шаблони з літеральним префіксом: рушій re не пробує кожну позицію тексту
+    SPACES_RE = re.compile(r'  +')
+    EMPTY_LINES_RE = re.compile(r'\n\s*\n')
+    EMPTY_CELLS_RE = re.compile(r'\| ?\|')
+    
+    # Тег -> розмітка, якою він замінюється
+    TAG_MARKUP = {
+        'caption': '\n**', '/caption': '**\n',
+        'tr': '\n',
+        'td': ' ', '/td': ' |',
+        'th': ' **', '/th': '** |',
+        'p': '\n', '/p': '\n',
+        'br': '\n',
+        'b': '**', '/b': '**',
+    }
+    for _level in range(1, 7):
+        TAG_MARKUP[f'h{_level}'] = '\n**'
+        TAG_MARKUP[f'/h{_level}'] = '**\n'
+    TAG_MARKUP.update({name.upper(): markup for name, markup in TAG_MARKUP.items()})
+    del _level
+    # Заголовки, що без закриваючого тегу закінчуються з початком наступного рядка, комірки чи заголовка
+    BLOCK_BOLD_TAGS = frozenset(['caption', 'th'] + [f'h{level}' for level in range(1, 7)])
+    BLOCK_TAGS = BLOCK_BOLD_TAGS | {'tr', 'td', 'p'}
+    
+    def convert(self, html_text):
+        """HTML -> текст"""
+        if '<!--' in html_text or '<s' in html_text or '<S' in html_text:
+            html_text = self.IGNORED_RE.sub('', html_text)
+        if 'font' in html_text or 'FONT' in html_text:
+            html_text = self.convert_fonts(html_text)
+        
+        # Непарні елементи - текст, парні - імена тегів
+        parts = self.TAG_RE.split(html_text)
+        parts[1::2], closing = self.tag_markup(parts[1::2])
+        parts[-1] += closing
+        text = ''.join(parts)
+        
+        if '&' in text:
+            text = self.decode_entities(text)
+        
+        text = self.SPACES_RE.sub(' ', text)
+        text = self.EMPTY_LINES_RE.sub('\n', text)
+        return self.EMPTY_CELLS_RE.sub('|', text)
+    
+    def tag_markup(self, names):
+        """Розмітка тегів та закриття незакритого жирного тексту в кінці.
+        
+        Як і для <font>, ** виводиться лише парами: непарний маркер ламає Markdown,
+        і Telegram відхиляє повідомлення (400).
+        """
+        markup = self.TAG_MARKUP.get
+        values = [markup(name) or markup(name.lower(), '') for name in names]
+        # Звичайний звіт: кожен тег жирного тексту одразу закривається своїм закриваючим тегом
+        bold = [name for name, value in zip(names, values) if '**' in value]
+        if not len(bold) % 2 and all(close == '/' + tag for tag, close in zip(bold[::2], bold[1::2])):
+            return values, ''
+        
+        opened = []
+        for i, name in enumerate(names):
+            value = values[i]
+            if not opened and '**' not in value:
+                continue
+            tag = name.lower()
+            prefix = ''
+            if opened and tag in self.BLOCK_TAGS:
+                # <caption> чи <th> без закриваючого тегу закінчується перед наступним рядком або коміркою
+                unclosed = sum(1 for t in opened if t in self.BLOCK_BOLD_TAGS)
+                if unclosed:
+                    opened = [t for t in opened if t not in self.BLOCK_BOLD_TAGS]
+                    prefix = '**' * unclosed
+            if '**' in value:
+                if tag[0] != '/':
+                    opened.append(tag)
+                elif tag[1:] in opened:
+                    del opened[len(opened) - 1 - opened[::-1].index(tag[1:])]
+                else:
+                    # Закриваючий тег без відкриваючого
+                    value = value.replace('**', '')
+            values[i] = prefix + value
+        return values, '**' * len(opened)
+    
+    def convert_fonts(self, html_text):
+        """Кольоровий текст <font color> -> курсив"""
+        stack = []
+        
+        def replace(match):
+            if match.group(1):
+                return '*' if stack and stack.pop() else ''
+            colored = 'color' in match.group(2).lower()
+            stack.append(colored)
+            return '*' if colored else ''
+        
+        return self.FONT_RE.sub(replace, html_text)
+    
+    def decode_entities(self, text):
+        """Декодування HTML entities: часті - через str.replace, решта - html.unescape"""
+        text = (text.replace('&nbsp;', ' ')
+                    .replace('&quot;', '"')
+                    .replace('&lt;', '<')
+                    .replace('&gt;', '>'))
+        if self.OTHER_ENTITY_RE.search(text):
+            return html.unescape(text).replace('\xa0', ' ')
+        return text.replace('&amp;', '&')
+
+# Ліміт довжини повідомлення Telegram в кодових одиницях UTF-16
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Максимум файлів в одному альбомі sendMediaGroup
+MEDIA_GROUP_LIMIT = 10
+# Найбільший файл, який Bot API приймає від бота (50 МБ)
+TELEGRAM_FILE_LIMIT = 52428800
+
+def utf16_len(text):
+    """Довжина тексту так, як її рахує Telegram (emoji поза BMP займають дві одиниці)"""
+    return len(text.encode('utf-16-le')) // 2
+
+class MarkdownSplitter:
+    """Розбиття тексту на частини за довжиною в UTF-16 без розриву сутностей Markdown.
+    
+    Частини розриваються лише між рядками, де всі *, _, ` та ``` закриті; за один прохід
+    рядки збираються в списки і з'єднуються один раз на частину.
+    """
+    MARKER_RE = re.compile(r'\\.|```|[*_`]')
+    CUT_RE = re.compile(r'\\.|```|[*_` ]')
+    # Запас на маркер (з пробілом), що закриває сутність при вимушеному розриві
+    MARKER_RESERVE = 4
+    # Менший ліміт не залишає місця для тексту між маркерами
+    MIN_LENGTH = 32
+    
+    def toggle(self, state, token):
+        """Стан розмітки після маркера: None або відкритий маркер"""
+        if token[0] == '\\':
+            return state
+        if state is None:
+            return token
+        # У `code` та ```pre``` інша розмітка не діє
+        if state == token or (state == '`' and token == '```'):
+            return None
+        return state
+    
+    def scan(self, line, state):
+        for match in self.MARKER_RE.finditer(line):
+            state = self.toggle(state, match.group())
+        return state
+    
+    def split(self, text, max_length, first_length=None):
+        """Частини не довші за max_length (перша - за first_length) одиниць UTF-16"""
+        max_length = max(max_length, self.MIN_LENGTH)
+        parts = []
+        limit = [max(first_length or max_length, self.MIN_LENGTH)]
+        current = []
+        # Довжина зібраних рядків разом з розділювачами "\n"
+        current_size = 0
+        
+        def emit(lines):
+            part = '\n'.join(lines).strip()
+            if part:
+                parts.append(part)
+                limit[0] = max_length
+        
+        def add_block(block, block_size):
+            nonlocal current, current_size
+            if current_size + block_size <= limit[0] + 1:
+                current.extend(block)
+                current_size += block_size
+                return
+            emit(current)
+            current, current_size = [], 0
+            if block_size <= limit[0] + 1:
+                current, current_size = block, block_size
+                return
+            
+            # Блок не вміщується в одне повідомлення: розрив між рядками із закриттям
+            # незавершеної сутності та повторним відкриттям у наступній частині
+            state = None
+            for line in block:
+                size = utf16_len(line) + 1
+                next_state = self.scan(line, state)
+                if current and current_size + size > limit[0] + 1 - self.MARKER_RESERVE:
+                    if state:
+                        current[-1] = self.close(current[-1], state)
+                        line = self.reopen(state, line)
+                        size = utf16_len(line) + 1
+                    emit(current)
+                    current, current_size = [], 0
+                state = next_state
+                if size > limit[0] + 1 - self.MARKER_RESERVE:
+                    pieces = self.split_line(line, limit[0] - self.MARKER_RESERVE)
+                    for piece in pieces[:-1]:
+                        emit([piece])
+                    line = pieces[-1]
+                    size = utf16_len(line) + 1
+                current.append(line)
+                current_size += size
+        
+        block, block_size, state = [], 0, None
+        for line in text.split('\n'):
+            block.append(line)
+            block_size += utf16_len(line) + 1
+            state = self.scan(line, state)
+            # Рядки з відкритою сутністю (наприклад, ```pre```) нероздільні
+            if state is None:
+                add_block(block, block_size)
+                block, block_size = [], 0
+        if block:
+            add_block(block, block_size)
+        emit(current)
+        return parts
+    
+    def split_line(self, line, limit):
+        """Рядок, довший за ліміт: розрив на пробілі поза розміткою, інакше - із закриттям маркера"""
+        pieces = []
+        while utf16_len(line) > limit:
+            end = self.char_index(line, limit - self.MARKER_RESERVE)
+            cut, cut_state, state = None, None, None
+            for match in self.CUT_RE.finditer(line):
+                # Екранування чи ``` на межі не розриваємо
+                if match.end() > end:
+                    end = min(end, match.start())
+                    break
+                token = match.group()
+                if token == ' ':
+                    if state is None and match.start() > 0:
+                        cut, cut_state = match.start(), None
+                    continue
+                state = self.toggle(state, token)
+            if cut is None:
+                cut, cut_state = end, state
+            
+            piece, line = line[:cut], line[cut:]
+            if cut_state:
+                piece = self.close(piece, cut_state)
+                line = self.reopen(cut_state, line)
+            else:
+                line = line.lstrip(' ')
+            pieces.append(piece.rstrip())
+        pieces.append(line)
+        return pieces
+    
+    @staticmethod
+    def close(text, marker):
+        """Закриття сутності в кінці частини (маркер не повинен злитися з \\ чи іншими `)"""
+        if (len(text) - len(text.rstrip('\\'))) % 2 or (marker[0] == '`' and text.endswith('`')):
+            text += ' '
+        return text + marker
+    
+    @staticmethod
+    def reopen(marker, text):
+        """Повторне відкриття сутності на початку наступної частини"""
+        if marker[0] == '`' and text.startswith('`'):
+            return marker + ' ' + text
+        return marker + text
+    
+    @staticmethod
+    def char_index(text, units):
+        """Найбільша кількість символів з початку тексту, що займає не більше units одиниць UTF-16"""
+        if utf16_len(text) == len(text):
+            return min(len(text), units)
+        count = 0
+        for index, char in enumerate(text):
+            count += 2 if ord(char) > 0xFFFF else 1
+            if count > units:
+                return index
+        return len(text)
+
+class ReportFormat:
+    """Форматування звіту каси за таблицями правил.
+    
+    Новий тип звіту (інша каса чи варіант звіту) - це підклас з власними таблицями,
+    зареєстрований через register_report_format; основний цикл при цьому не змінюється.
+    """
+    # Підрядки, за якими текст розпізнається як звіт цього типу
+    MARKERS = ()
+    # Підрядок у рядку -> заміна всього рядка
+    CONTAINS = {}
+    # Рядок повністю -> заміна (None - рядок пропускається)
+    LINES = {}
+    # Префікс рядка -> шаблон, {} - решта рядка
+    PREFIXES = {}
+    # Рядки "Ключ | Значення |": (ключові слова, emoji); при збігу кількох перемагає перше правило
+    KEYWORDS = ()
+    DEFAULT_EMOJI = "📊"
+    # Заголовок таблиці товарів: (перша колонка, підрядок другої колонки) та рядки, якими він замінюється
+    TABLE_HEADER = None
+    TABLE_HEADER_LINES = ()
+    # Довші назви товарів скорочуються
+    MAX_NAME_LENGTH = 35
+    # Дані для історії продажів: префікс рядка -> поле звіту
+    FIELDS = {}
+    # Рядок-заголовок розділу підсумків -> назва розділу
+    SECTIONS = {}
+    # Рядки "Ключ | Значення |" розділу: (ключові слова, показник або None - не зберігати);
+    # перемагає перше правило
+    TOTALS = ()
+    
+    def __init__(self):
+        # Усі підрядки та ключові слова компілюються один раз в альтернації
+        self.contains_re = self.alternation(self.CONTAINS)
+        self.prefix_re = self.alternation(self.PREFIXES, '(', ')(.*)')
+        self.keyword_rules = {}
+        for index, (words, emoji) in enumerate(self.KEYWORDS):
+            for word in words:
+                self.keyword_rules.setdefault(word.lower(), index)
+        self.keyword_re = self.alternation(self.keyword_rules, flags=re.IGNORECASE)
+        self.field_re = self.alternation(self.FIELDS, '(', ')(.*)')
+        self.total_rules = {}
+        for index, (words, metric) in enumerate(self.TOTALS):
+            for word in words:
+                self.total_rules.setdefault(word.lower(), index)
+        self.total_re = self.alternation(self.total_rules, flags=re.IGNORECASE)
+    
+    @staticmethod
+    def alternation(words, prefix='(?:', suffix=')', flags=0):
+        """Один regex з усіх слів (довші першими), None для порожньої таблиці"""
+        if not words:
+            return None
+        pattern = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+        return re.compile(prefix + pattern + suffix, flags)
+    
+    def matches(self, text):
+        return any(marker in text for marker in self.MARKERS)
+    
+    def format(self, text):
+        """Форматування тексту звіту (після очищення HTML)"""
+        formatted_lines = []
+        in_table = False
+        
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            
+            match = self.contains_re and self.contains_re.search(line)
+            if match:
+                formatted_lines.append(self.CONTAINS[match.group()])
+                continue
+            
+            if line in self.LINES:
+                if self.LINES[line] is not None:
+                    formatted_lines.append(self.LINES[line])
+                continue
+            
+            match = self.prefix_re and self.prefix_re.match(line)
+            if match:
+                prefix, rest = match.groups()
+                formatted_lines.append(self.PREFIXES[prefix].format(rest.strip()))
+                continue
+            
+            # Обробка рядків з даними (формат "Ключ | Значення |")
+            if line.count('|') >= 2:
+                parts = [p.strip() for p in line.split('|')]
+                if len(parts) >= 3 and parts[0] and parts[1]:
+                    if self.TABLE_HEADER and parts[0] == self.TABLE_HEADER[0] and self.TABLE_HEADER[1] in parts[1]:
+                        formatted_lines.extend(self.TABLE_HEADER_LINES)
+                        in_table = True
+                    elif in_table and parts[0].isdigit():
+                        formatted_lines.extend(self.format_item(parts))
+                    else:
+                        formatted_lines.append(self.format_value(parts[0], parts[1]))
+                    continue
+            
+            formatted_lines.append(line)
+        
+        return '\n'.join(formatted_lines)
+    
+    def parse(self, text):
+        """Дані звіту: поля фільтра, підсумки розділів та рядки таблиці товарів
+        
+        Повертає {'fields': {поле: текст}, 'totals': {розділ: {показник: число}},
+        'items': [(№, назва, кількість, вартість, прибуток)]}.
+        """
+        figures = {'fields': {}, 'totals': {}, 'items': []}
+        section = None
+        in_table = False
+        
+        for line in text.split('\n'):
+            line = line.strip().strip('*').strip()
+            if not line:
+                continue
+            
+            if line in self.SECTIONS:
+                section = self.SECTIONS[line]
+                in_table = False
+                continue
+            
+            match = self.field_re and self.field_re.match(line)
+            if match:
+                figures['fields'][self.FIELDS[match.group(1)]] = match.group(2).strip()
+                continue
+            
+            if line.count('|') < 2:
+                continue
+            parts = [p.strip().strip('*').strip() for p in line.split('|')]
+            if len(parts) < 3 or not parts[0] or not parts[1]:
+                continue
+            if self.TABLE_HEADER and parts[0] == self.TABLE_HEADER[0] and self.TABLE_HEADER[1] in parts[1]:
+                in_table = True
+                section = None
+            elif in_table and parts[0].isdigit():
+                figures['items'].append((
+                    int(parts[0]),
+                    parts[1],
+                    parse_number(parts[2]) if len(parts) > 2 else None,
+                    parse_number(parts[3]) if len(parts) > 3 else None,
+                    parse_number(parts[4]) if len(parts) > 4 else None,
+                ))
+            elif section is not None:
+                rule = self.first_rule(self.total_re, self.total_rules, parts[0])
+                metric = self.TOTALS[rule][1] if rule is not None else None
+                value = parse_number(parts[1])
+                if metric and value is not None:
+                    figures['totals'].setdefault(section, {}).setdefault(metric, value)
+        
+        return figures
+    
+    @staticmethod
+    def first_rule(regex, rules, key):
+        """Номер першого правила, ключове слово якого є в ключі (або None)"""
+        rule = None
+        if regex:
+            for match in regex.finditer(key):
+                index = rules[match.group().lower()]
+                if rule is None or index < rule:
+                    rule = index
+        return rule
+    
+    def table_rows(self, text):
+        """Комірки рядків таблиць звіту (для CSV), без розмітки Markdown"""
+        for line in text.split('\n'):
+            if line.count('|') < 2:
+                continue
+            cells = [cell.strip().strip('*').strip() for cell in line.strip().split('|')]
+            if cells and not cells[-1]:
+                cells.pop()
+            if any(cells):
+                yield cells
+    
+    def format_value(self, key, value):
+        """Рядок "Ключ | Значення" з emoji першого правила, ключове слово якого є в ключі"""
+        rule = self.first_rule(self.keyword_re, self.keyword_rules, key)
+        emoji = self.DEFAULT_EMOJI if rule is None else self.KEYWORDS[rule][1]
+        return f"{emoji} **{key}:** `{value}`"
+    
+    def format_item(self, parts):
+        """Рядок таблиці товарів"""
+        num = parts[0]
+        name = parts[1]
+        qty = parts[2] if len(parts) > 2 else "—"
+        cost = parts[3] if len(parts) > 3 else "—"
+        profit = parts[4] if len(parts) > 4 else "—"
+        
+        if len(name) > self.MAX_NAME_LENGTH:
+            name = name[:self.MAX_NAME_LENGTH - 3] + "..."
+        
+        return [
+            f"\n`{num:>2}.` **{name}**",
+            f"   📦 Кількість: `{qty}`",
+            f"   💵 Вартість: `{cost}`",
+            f"   📈 Прибуток: `{profit}`",
+            "   ────────────────────────────",
+        ]
+
+def parse_number(value):
+    """Число зі звіту ("12 345,67", "2,000", "13.50") або None"""
+    value = value.strip().strip('*').replace('\xa0', '').replace(' ', '').replace(',', '.')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+# Зареєстровані типи звітів; перевіряються в порядку реєстрації
+REPORT_FORMATS = []
+
+def register_report_format(format_class):
+    """Реєстрація типу звіту (можна використовувати як декоратор класу)"""
+    REPORT_FORMATS.append(format_class())
+    return format_class
+
+@register_report_format
+class SampoReportFormat(ReportFormat):
+    """Звіти SAMPO Reports та Unipro Reports"""
+    MARKERS = ('SAMPO Reports', 'Unipro Reports')
+    CONTAINS = {
+        'SAMPO Reports': "🏪 **SAMPO REPORTS**",
+        'Unipro Reports': "🏪 **SAMPO REPORTS**",
+    }
+    LINES = {
+        'Отправка по команде пользователя.': "📤 Відправка по команді користувача",
+        'Фильтр': "\n🔍 **ФІЛЬТР**",
+        'Сводный отчет': "\n📊 **ЗВЕДЕНИЙ ЗВІТ**",
+        'ПРОДАЖИ': "\n💰 **ПРОДАЖІ**",
+        'ВОЗВРАТЫ': "\n📉 **ПОВЕРНЕННЯ**",
+        # Заголовок додається разом із заголовком таблиці товарів
+        'Отчет по товарам': None,
+    }
+    PREFIXES = {
+        'Организации:': "🏢 **Organisacija:** {}",
+        'Склады:': "🏪 **Склад:** {}",
+        'Период:': "🗓 **Період:** {}",
+    }
+    KEYWORDS = (
+        (('сумма', 'сума'), "💵"),
+        (('скидка', 'знижка'), "🏷️"),
+        (('прибыль', 'прибуток'), "📈"),
+        (('средний', 'середній'), "🧾"),
+        (('к-во', 'к-сть', 'чеков', 'чеків'), "🧾"),
+        (('убыток', 'збиток'), "📉"),
+    )
+    TABLE_HEADER = ('№', 'Имя')
+    TABLE_HEADER_LINES = (
+        "\n🛒 **ЗВІТ ПО ТОВАРАХ**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        "📋 **СПИСОК ТОВАРІВ:**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+    )
+    FIELDS = {
+        'Организации:': 'organisation',
+        'Склады:': 'warehouse',
+        'Период:': 'period',
+    }
+    SECTIONS = {
+        'ПРОДАЖИ': 'sales',
+        'ВОЗВРАТЫ': 'returns',
+    }
+    # Середній чек не зберігається - це сума, поділена на кількість чеків
+    TOTALS = (
+        (('средний', 'середній'), None),
+        (('к-во', 'к-сть', 'чеков', 'чеків'), 'receipts'),
+        (('сумма', 'сума'), 'amount'),
+        (('скидка', 'знижка'), 'discount'),
+        (('прибыль', 'прибуток'), 'profit'),
+        (('убыток', 'збиток'), 'loss'),
+    )
+
+class Report:
+    """Звіт, що проходить етапи обробки; кожен етап зберігає свій результат"""
+    def __init__(self, data=b"", mail_from="", rcpt_to=None, path=None, msg=None,
+                 delivery=None, delivered=None, progress=None):
+        self.data = data
+        self.mail_from = mail_from
+        self.rcpt_to = rcpt_to or []
+        self.path = path
+        self.empty = False
+        # Лист може бути розібраний ще під час прийому DATA
+        self.msg = msg
+        self.parse_error = None
+        self.subject = None
+        self.sender = None
+        self.body = None
+        self.text = None
+        self.formatted = None
+        # Дані звіту (ReportFormat.parse) для історії продажів
+        self.figures = None
+        # Повідомлення для відправки: текст (str) або файл (TelegramDocument)
+        self.messages = None
+        self.document = None
+        # Вкладення листа (TelegramDocument), що пересилаються після тексту
+        self.attachments = []
+        # Примітки про вкладення, які Telegram не прийме (порожні або завеликі)
+        self.skipped_attachments = []
+        # Назва етапу -> час виконання в секундах
+        self.timings = {}
+        self.header_cache = {}
+        # (id в черзі, кількість спроб) для листа з черги доставки
+        self.delivery = delivery
+        # Чати, куди звіт вже доставлено попередніми спробами
+        self.delivered = set(delivered or ())
+        # Чат -> [відправлено частин, всього частин] для чатів, доставку в які перервано
+        self.progress = dict(progress or {})
+        # Незавершені частини доставки (потік доставки та зведення, в яких чекає звіт)
+        self.pending = 1
+        self.error = None
+        # Хеш відправника, теми, тексту та вкладень: однаковий для повторів того ж звіту
+        self.digest = None
+        self.duplicate = False
+    
+    def is_empty(self):
+        """Порожній лист (без копіювання даних)"""
+        if self.path:
+            return os.path.getsize(self.path) == 0
+        return not self.data or self.data.isspace()
+    
+    def header(self, name, default=""):
+        """Декодований заголовок розібраного листа"""
+        key = name.lower()
+        if key not in self.header_cache:
+            self.header_cache[key] = self._decode_header(key)
+        return self.header_cache[key] or default
+    
+    def _decode_header(self, key):
+        try:
+            value = self.msg.get(key)
+            value = str(value) if value is not None else ""
+        except Exception:
+            value = "\ufffd"
+        
+        if "\ufffd" in value:
+            # Заголовок у "сирому" 8-бітному кодуванні каси (без RFC 2047)
+            for raw_name, raw_value in self.msg.raw_items():
+                if raw_name.lower() == key:
+                    raw = raw_value.encode('ascii', 'surrogateescape')
+                    try:
+                        value = raw.decode('utf-8')
+                    except UnicodeDecodeError:
+                        value = raw.decode('windows-1251', errors='replace')
+                    value = " ".join(value.split())
+                    break
+        return value
+    
+    def raw_head(self, size):
+        """Початок сирих даних листа як текст"""
+        if self.path:
+            with open(self.path, 'rb') as f:
+                head = f.read(size)
+        else:
+            head = self.data[:size]
+        return head.decode('utf-8', errors='ignore')
+
+MAIL_FROM_RE = re.compile(r'MAIL\s+FROM:\s*<?([^<>\s]*)>?(.*)', re.IGNORECASE)
+RCPT_TO_RE = re.compile(r'RCPT\s+TO:\s*<?([^<>\s]*)>?', re.IGNORECASE)
+MAIL_SIZE_RE = re.compile(r'\bSIZE=(\d+)', re.IGNORECASE)
 
 class FakeSSLSMTPServer:
-    def __init__(self, host='localhost', port=25, token='', chat_id=''):
+    # receive виконується сесією (лист уже в черзі), далі - етапи обробки
+    PIPELINE_STAGES = ("parse", "extract", "normalize", "dedup", "format", "store", "split", "deliver")
+    
+    def __init__(self, host='localhost', port=25, token='', chat_id='', engine='asyncio',
+                 processing_workers=4, max_sessions=100, listen_backlog=128,
+                 spool_path=SPOOL_FILE, telegram_options=None, retry_max_attempts=8,
+                 retry_base_delay=5, retry_max_delay=600, max_message_size=52428800,
+                 message_memory_limit=1048576, message_parse_limit=10485760, spool_dir=SPOOL_DIR, digest_window=0,
+                 digest_chats=None, dedup_window=600, dedup_cache_size=1024, dedup_persist=True,
+                 routes=None, fanout_workers=8, document_threshold=0, document_format='text',
+                 reports_path=REPORTS_FILE, daily_summary_time='', daily_summary_chat='',
+                 checkpoint_interval=60, aggregates_path=AGGREGATES_FILE, metrics_port=0):
         self.host = host
         self.port = port
         self.token = token
         self.chat_id = chat_id
+        self.engine = engine
+        self.processing_workers = processing_workers
+        self.max_sessions = max_sessions
+        self.listen_backlog = listen_backlog
         self.running = False
         self.server_socket = None
+        self.spool_path = spool_path
+        self.retry_max_attempts = retry_max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_message_size = max_message_size
+        self.message_memory_limit = message_memory_limit
+        self.message_parse_limit = message_parse_limit
+        self.spool_dir = spool_dir
+        self.telegram_options = telegram_options or {}
+        self.telegram = get_telegram_client(token, **self.telegram_options)
+        self.router = MessageRouter(routes or [], (token, chat_id))
+        # Кожен чат має свою чергу; різні чати обслуговуються паралельно
+        self.scheduler = ChatDeliveryScheduler(self.deliver_to, fanout_workers)
+        self.spool = None
+        self.delivery_threads = []
+        self.session_pool = None
+        self.active_sessions = 0
+        self.sessions_lock = threading.Lock()
+        self.loop = None
+        self.stop_event = None
+        # id листа в черзі -> лист, розібраний під час прийому
+        self.parsed = {}
+        self.parsed_lock = threading.Lock()
+        self.charsets = CharsetDetector()
+        # Зведення: вікно в секундах (0 - вимкнено), окремо для кожного чату
+        self.digest_window = digest_window
+        self.digest_chats = digest_chats or {}
+        self.digests = {}
+        self.digest_lock = threading.Lock()
+        # Повторно надіслані касою звіти (0 - не перевіряти)
+        self.dedup_window = dedup_window
+        self.dedup_cache_size = dedup_cache_size
+        self.dedup_persist = dedup_persist
+        self.dedup = None
+        # Звіт довший за document_threshold повідомлень надсилається файлом (0 - ніколи)
+        self.document_threshold = document_threshold
+        self.document_format = document_format
+        # Дані звітів для історії продажів ("" - не зберігати)
+        self.reports_path = reports_path
+        self.reports = None
+        # Підсумок дня о daily_summary_time ("ГГ:ХХ", "" - вимкнено)
+        self.daily_summary_time = daily_summary_time
+        self.daily_summary_chat = daily_summary_chat
+        self.checkpoint_interval = checkpoint_interval
+        self.aggregates_path = aggregates_path
+        self.aggregates = None
+        self.summary_event = threading.Event()
+        # Сторінка метрик Prometheus на localhost (0 - вимкнено)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
         
     def start(self):
         """Запуск SMTP сервера"""
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.spool = DeliverySpool(self.spool_path)
+            if self.dedup_window > 0:
+                self.dedup = DuplicateCache(
+                    self.dedup_cache_size,
+                    self.dedup_window,
+                    self.spool if self.dedup_persist else None
+                )
+            if self.reports_path:
+                self.reports = ReportStore(self.reports_path)
+            if self.summary_clock() is not None:
+                self.aggregates = DailyAggregates(self.aggregates_path)
+        except Exception as e:
+            return
+        
+        self.running = True
+        self.start_delivery_workers()
+        if self.metrics_port:
+            self.start_metrics()
+        if self.aggregates is not None:
+            self.summary_event.clear()
+            threading.Thread(target=self.summary_worker, name="smtp-summary", daemon=True).start()
+        
+        if self.engine == 'asyncio':
+            try:
+                asyncio.run(self.serve_async())
+            except Exception as e:
+                pass
+            finally:
+                self.running = False
+            return
+        
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.listen_backlog)
+            
+            self.session_pool = ThreadPoolExecutor(
+                max_workers=self.max_sessions,
+                thread_name_prefix="smtp-session"
+            )
             
             self.running = True
             
@@ -47,12 +2185,11 @@ class FakeSSLSMTPServer:
                 try:
                     client_socket, address = self.server_socket.accept()
                     
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_socket,),
-                        daemon=True
-                    )
-                    client_thread.start()
+                    if not self.admit_session():
+                        self.reject_client(client_socket)
+                        continue
+                    
+                    self.session_pool.submit(self.handle_client, client_socket)
                     
                 except socket.error:
                     if self.running:
@@ -60,158 +2197,562 @@ class FakeSSLSMTPServer:
                     break
                     
         except Exception as e:
-            pass
-            
-    def handle_client(self, client_socket):
-        """Обробка клієнта"""
+            pass
+        finally:
+            self.running = False
+            
+    def new_session(self):
+        """Новий стан SMTP сесії з лімітами сервера"""
+        return SMTPSession(self.max_message_size, self.message_memory_limit, self.spool_dir,
+                           self.message_parse_limit)
+    
+    def admit_session(self):
+        """Резервування місця для нової сесії, False якщо сервер перевантажено"""
+        with self.sessions_lock:
+            if self.active_sessions >= self.max_sessions:
+                METRICS.inc("smtp_connections_total", result="rejected")
+                return False
+            self.active_sessions += 1
+        METRICS.inc("smtp_connections_total", result="accepted")
+        return True
+    
+    def release_session(self, started=None):
+        """Звільнення місця сесії (started - час початку для гістограми тривалості)"""
+        with self.sessions_lock:
+            self.active_sessions -= 1
+        if started is not None:
+            METRICS.observe("smtp_session_duration_seconds", time.perf_counter() - started)
+    
+    def reject_client(self, client_socket):
+        """Відмова клієнту при перевантаженні (каса повторить спробу)"""
+        try:
+            self.send_response(client_socket, "421 4.3.2 Try again later")
+        finally:
+            try:
+                client_socket.close()
+            except:
+                pass
+    
+    def handle_client(self, client_socket):
+        """Обробка клієнта"""
+        started = time.perf_counter()
+        try:
+            self.smtp_session(client_socket)
+        except Exception as e:
+            METRICS.inc("errors_total", where="session")
+        finally:
+            self.release_session(started)
+            try:
+                client_socket.close()
+            except:
+                pass
+    
+    def smtp_session(self, sock):
+        """SMTP сесія з виправленою обробкою DATA"""
+        session = self.new_session()
+        try:
+            time.sleep(0.1)
+            
+            self.send_response(sock, "220 localhost ESMTP Ready")
+            
+            buffer = SMTPLineBuffer()
+            sock.settimeout(30)
+            
+            while not session.closing:
+                try:
+                    responses, finished = self.handle_input(session, buffer)
+                    
+                    if finished:
+                        responses.append(self.finish_data(session))
+                    
+                    # Відповіді на пакет команд (PIPELINING) відправляємо одним пакетом
+                    if responses:
+                        self.send_response(sock, "\r\n".join(responses))
+                    
+                    if finished or session.closing:
+                        continue
+                    
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    buffer.feed(data)
+                        
+                except socket.timeout:
+                    break
+                except socket.error as e:
+                    break
+                except Exception as e:
+                    try:
+                        self.send_response(sock, "500 5.0.0 Помилка команди")
+                    except:
+                        pass
+                    
+        except Exception as e:
+            pass
+        finally:
+            # Незавершений лист (обрив з'єднання) не залишає файлів на диску
+            session.reset()
+    
+    def handle_input(self, session, buffer):
+        """Обробка всіх повних команд у буфері (PIPELINING).
+        
+        Повертає (відповіді, finished); finished=True означає, що лист отримано
+        повністю і перед подальшими командами треба викликати finish_data.
+        """
+        responses = []
+        
+        while not session.closing:
+            if session.bdat_remaining is not None:
+                if session.bdat_remaining:
+                    chunk = buffer.take(session.bdat_remaining)
+                    if not chunk:
+                        break
+                    session.add_chunk(chunk)
+                    if session.bdat_remaining:
+                        break
+                
+                session.bdat_remaining = None
+                if session.bdat_rejected:
+                    responses.append(session.bdat_rejected)
+                    session.bdat_rejected = None
+                    continue
+                if session.bdat_last:
+                    return responses, True
+                responses.append(f"250 2.0.0 Отримано {session.bdat_size} байт")
+                continue
+            
+            line = buffer.next_line()
+            if line is None:
+                break
+            
+            if session.in_data_mode:
+                if session.is_data_end(line):
+                    return responses, True
+                session.add_data_line(line)
+                continue
+            
+            command = line.decode('utf-8', errors='ignore').strip()
+            
+            if not command:
+                continue
+            
+            try:
+                response = self.handle_command(session, command)
+            except Exception as e:
+                response = "500 5.0.0 Помилка команди"
+            
+            if response:
+                responses.append(response)
+        
+        return responses, False
+    
+    def handle_command(self, session, command):
+        """Обробка однієї SMTP команди, повертає текст відповіді"""
+        cmd_parts = command.split()
+        cmd = cmd_parts[0].upper() if cmd_parts else ""
+        
+        if cmd == "HELO":
+            hostname = cmd_parts[1] if len(cmd_parts) > 1 else "невідомий"
+            return f"250 localhost Привіт {hostname}"
+            
+        elif cmd == "EHLO":
+            hostname = cmd_parts[1] if len(cmd_parts) > 1 else "невідомий"
+            responses = [
+                f"250-localhost Привіт {hostname}",
+                "250-AUTH LOGIN PLAIN",
+                "250-8BITMIME", 
+                "250-PIPELINING",
+                "250-CHUNKING",
+                f"250-SIZE {self.max_message_size}",
+                "250 HELP"
+            ]
+            return "\r\n".join(responses)
+            
+        elif cmd == "AUTH":
+            auth_type = cmd_parts[1].upper() if len(cmd_parts) > 1 else "LOGIN"
+            
+            if auth_type == "LOGIN":
+                session.auth_stage = "username"
+                return "334 VXNlcm5hbWU6"
+            elif auth_type == "PLAIN":
+                if len(cmd_parts) > 2:
+                    return "235 2.7.0 Автентифікація успішна"
+                else:
+                    return "334 "
+            else:
+                return "235 2.7.0 Автентифікація успішна"
+                
+        elif session.auth_stage == "username":
+            session.auth_stage = "password"
+            return "334 UGFzc3dvcmQ6"
+            
+        elif session.auth_stage == "password":
+            session.auth_stage = None
+            return "235 2.7.0 Автентифікація успішна"
+            
+        elif cmd == "MAIL":
+            match = MAIL_FROM_RE.match(command)
+            if not match:
+                return "501 5.5.4 Синтаксис: MAIL FROM:<адреса>"
+            # Параметр SIZE= дозволяє відхилити завеликий лист ще до передачі тіла;
+            # відправник при цьому не запам'ятовується, тож RCPT та DATA отримають 503
+            size = MAIL_SIZE_RE.search(match.group(2))
+            if size and int(size.group(1)) > self.max_message_size:
+                return "552 5.3.4 Розмір листа перевищує ліміт"
+            session.mail_from = match.group(1)
+            return "250 2.1.0 Добре"
+            
+        elif cmd == "RCPT":
+            if session.mail_from is None:
+                return "503 5.5.1 Спочатку потрібна команда MAIL"
+            match = RCPT_TO_RE.match(command)
+            if match:
+                session.rcpt_to.append(match.group(1))
+            return "250 2.1.5 Добре"
+            
+        elif cmd == "DATA":
+            rejected = self.transaction_error(session)
+            if rejected:
+                return rejected
+            session.start_data()
+            return "354 Закінчіть дані з <CR><LF>.<CR><LF>"
+            
+        elif cmd == "BDAT":
+            try:
+                size = int(cmd_parts[1])
+            except (IndexError, ValueError):
+                return "501 5.5.4 Синтаксис: BDAT <розмір> [LAST]"
+            last = len(cmd_parts) > 2 and cmd_parts[2].upper() == "LAST"
+            # Відповідь буде після отримання всіх байтів фрагмента
+            session.start_bdat(size, last)
+            # Байти фрагмента без транзакції все одно треба дочитати, щоб не сприйняти їх як команди
+            session.bdat_rejected = self.transaction_error(session)
+            return None
+            
+        elif cmd == "QUIT":
+            session.closing = True
+            return "221 2.0.0 До побачення"
+            
+        elif cmd == "RSET":
+            session.reset()
+            session.auth_stage = None
+            return "250 2.0.0 Добре"
+            
+        elif cmd == "NOOP":
+            return "250 2.0.0 Добре"
+            
+        elif cmd == "HELP":
+            return "214 2.0.0 Допомога доступна"
+            
+        else:
+            return "250 2.0.0 Добре"
+    
+    @staticmethod
+    def transaction_error(session):
+        """Відповідь 503, якщо для DATA/BDAT ще не прийнято MAIL або жодного RCPT"""
+        if session.mail_from is None:
+            return "503 5.5.1 Спочатку потрібна команда MAIL"
+        if not session.rcpt_to:
+            return "503 5.5.1 Спочатку потрібна команда RCPT"
+        return None
+    
+    def finish_data(self, session):
+        """Завершення DATA: збереження листа в черзі, повертає текст відповіді"""
+        if session.oversized:
+            session.reset()
+            METRICS.inc("smtp_messages_total", result="oversized")
+            return "552 5.3.4 Розмір листа перевищує ліміт"
+        
+        mail_from = session.mail_from
+        rcpt_to = session.rcpt_to
+        path = None
+        try:
+            METRICS.observe("smtp_message_size_bytes", session.sink.size, SIZE_BUCKETS)
+            email_data, path, parsed = session.take_message()
+            session.reset()
+            # 250 відповідаємо лише після запису на диск; доставку виконують потоки доставки.
+            # Потік доставки бере parsed_lock після claim, тож розібраний лист вже буде на місці
+            with self.parsed_lock:
+                msg_id = self.spool.enqueue(email_data, mail_from, rcpt_to, path)
+                if parsed is not None:
+                    self.parsed[msg_id] = parsed
+            METRICS.inc("smtp_messages_total", result="accepted")
+            return "250 2.0.0 Повідомлення прийнято для доставки"
+        except Exception as e:
+            METRICS.inc("smtp_messages_total", result="failed")
+            session.reset()
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return "450 4.0.0 Тимчасова помилка"
+    
+    def start_delivery_workers(self):
+        """Запуск пулу потоків доставки з черги"""
+        self.delivery_threads = []
+        for i in range(self.processing_workers):
+            thread = threading.Thread(
+                target=self.delivery_worker,
+                name=f"smtp-delivery-{i}",
+                daemon=True
+            )
+            thread.start()
+            self.delivery_threads.append(thread)
+    
+    def delivery_worker(self):
+        """Потік доставки: забирає листи з черги та відправляє в Telegram"""
+        while self.running:
+            try:
+                item = self.spool.claim(timeout=1.0)
+                if item is None:
+                    continue
+                msg_id, data, mail_from, rcpt_to, attempts, path, delivered, progress = item
+                # Повторні спроби (та листи після перезапуску) розбираються заново з черги
+                with self.parsed_lock:
+                    msg = self.parsed.pop(msg_id, None)
+                report = Report(data, mail_from, rcpt_to, path, msg,
+                                delivery=(msg_id, attempts), delivered=delivered, progress=progress)
+                try:
+                    self.run_pipeline(report)
+                except Exception as e:
+                    self.release_report(report, e)
+                else:
+                    self.release_report(report)
+            except Exception as e:
+                METRICS.inc("errors_total", where="delivery")
+                time.sleep(1)
+    
+    def start_metrics(self):
+        """Сторінка http://127.0.0.1:metrics_port/metrics; датчики читають стан цього сервера"""
+        try:
+            self.metrics_server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), MetricsHandler)
+        except Exception as e:
+            METRICS.inc("errors_total", where="metrics")
+            return
+        self.metrics_server.daemon_threads = True
+        METRICS.enabled = True
+        METRICS.gauge("smtp_active_sessions", lambda: self.active_sessions)
+        METRICS.gauge("spool_pending_messages", self.spool.pending_count)
+        METRICS.gauge("telegram_queue_depth", self.scheduler.pending_count)
+        if self.dedup is not None:
+            METRICS.gauge("dedup_duplicates_total", lambda: self.dedup.hits)
+        threading.Thread(target=self.metrics_server.serve_forever, name="smtp-metrics", daemon=True).start()
+    
+    def summary_clock(self):
+        """Час підсумку дня (години, хвилини) або None, якщо не задано чи задано невірно"""
         try:
-            self.smtp_session(client_socket)
+            hour, minute = (int(part) for part in self.daily_summary_time.split(':'))
+            datetime.now().replace(hour=hour, minute=minute)
+            return hour, minute
+        except Exception:
+            return None
+    
+    def summary_worker(self):
+        """Потік денних підсумків: періодичне збереження стану та підсумок дня у заданий час"""
+        next_summary = self.next_summary()
+        while self.running:
+            self.summary_event.wait(max(0, min(next_summary - time.time(), self.checkpoint_interval)))
+            try:
+                if time.time() >= next_summary:
+                    next_summary = self.next_summary()
+                    self.send_daily_summary()
+                self.aggregates.checkpoint()
+            except Exception as e:
+                METRICS.inc("errors_total", where="summary")
+                time.sleep(1)
+        try:
+            self.aggregates.checkpoint()
         except Exception as e:
             pass
-        finally:
+    
+    def next_summary(self):
+        """Час наступного підсумку дня (timestamp)"""
+        hour, minute = self.summary_clock()
+        now = datetime.now()
+        moment = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if moment <= now:
+            moment += timedelta(days=1)
+        return moment.timestamp()
+    
+    def send_daily_summary(self):
+        """Підсумок за сьогодні (та дні, підсумок яких ще не вдалося відправити)"""
+        days = self.aggregates.take(datetime.now().strftime('%Y-%m-%d'))
+        if not days:
+            return
+        try:
+            messages = self.build_summary_messages(days)
+        except Exception as e:
+            self.aggregates.restore(days)
+            raise
+        
+        # Забрані дні зберігаються в checkpoint, доки Telegram не підтвердить відправку
+        def done(error):
+            if error is not None:
+                self.aggregates.restore(days)
+                return
+            self.aggregates.confirm(days)
             try:
-                client_socket.close()
+                self.aggregates.checkpoint()
+            except Exception as e:
+                METRICS.inc("errors_total", where="summary")
+        
+        self.scheduler.submit((self.token, self.daily_summary_chat or self.chat_id), messages, done)
+    
+    def build_summary_messages(self, days):
+        """Повідомлення підсумку дня по організаціях і складах"""
+        header = "📅 **ПІДСУМОК ДНЯ**\n\n"
+        header += f"⏰ **Час:** {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
+        header += "═" * 40 + "\n"
+        
+        lines = []
+        for day, stores in sorted(days.items()):
+            lines.append(f"\n🗓 **{datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m.%Y')}**")
+            overall = {}
+            for (organisation, warehouse), totals in sorted(stores.items()):
+                lines.append(f"\n🏢 **{organisation or '—'}**")
+                lines.append(f"🏪 **{warehouse or '—'}** (звітів: {totals.get('reports', 0)})")
+                lines.extend(self.summary_lines(totals))
+                for name, value in totals.items():
+                    overall[name] = overall.get(name, 0) + value
+            if len(stores) > 1:
+                lines.append(f"\n📊 **Разом** (звітів: {overall.get('reports', 0)})")
+                lines.extend(self.summary_lines(overall))
+        return self.paginate(header, "\n".join(lines))
+    
+    @staticmethod
+    def summary_lines(totals):
+        lines = []
+        for name, emoji, title in DailyAggregates.METRICS:
+            if name in totals:
+                value = totals[name]
+                if name.endswith(".receipts"):
+                    text = f"{value:,.0f}".replace(",", " ")
+                else:
+                    text = f"{value:,.2f}".replace(",", " ").replace(".", ",")
+                lines.append(f"{emoji} {title}: `{text}`")
+        return lines
+    
+    def release_report(self, report, error=None):
+        """Завершення частини доставки; після останньої лист видаляється з черги або йде на повтор"""
+        with self.digest_lock:
+            # Тимчасова помилка важливіша за постійну: лист має піти на повтор
+            if error is not None and (report.error is None or getattr(report.error, 'permanent', False)):
+                report.error = error
+            report.pending -= 1
+            if report.pending:
+                return
+        
+        msg_id, attempts = report.delivery
+        if report.error is not None:
+            self.delivery_failed(msg_id, attempts, report.error)
+        else:
+            self.spool.complete(msg_id)
+            if not report.duplicate:
+                METRICS.inc("reports_total", result="delivered")
+    
+    def delivery_failed(self, msg_id, attempts, error):
+        """Планування повтору з експоненційною затримкою або перенос до недоставлених"""
+        error_text = f"{type(error).__name__}: {error}"[:500]
+        attempts += 1
+        
+        if getattr(error, 'permanent', False) or attempts >= self.retry_max_attempts:
+            self.spool.dead(msg_id, error_text)
+            METRICS.inc("reports_total", result="dead")
+            if self.dedup:
+                self.dedup.forget(msg_id)
+            return
+        
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempts - 1))
+        # Випадкова складова, щоб повтори від різних кас не збігались у часі
+        delay = random.uniform(delay / 2, delay)
+        self.spool.retry(msg_id, error_text, delay)
+        METRICS.inc("reports_total", result="retry")
+    
+    async def serve_async(self):
+        """Asyncio рушій: усі сесії в одному потоці"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        
+        server = await asyncio.start_server(
+            self.async_smtp_session,
+            self.host,
+            self.port,
+            reuse_address=True,
+            backlog=self.listen_backlog
+        )
+        
+        self.running = True
+        
+        async with server:
+            await self.stop_event.wait()
+    
+    async def async_smtp_session(self, reader, writer):
+        """Coroutine-версія SMTP сесії"""
+        if not self.admit_session():
+            try:
+                await self.async_send_response(writer, "421 4.3.2 Try again later")
+                writer.close()
+                await writer.wait_closed()
             except:
                 pass
-    
-    def smtp_session(self, sock):
-        """SMTP сесія з виправленою обробкою DATA"""
+            return
+        
+        started = time.perf_counter()
+        session = self.new_session()
         try:
-            import time
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             
-            self.send_response(sock, "220 localhost ESMTP Ready")
+            await self.async_send_response(writer, "220 localhost ESMTP Ready")
             
-            email_data = ""
-            in_data_mode = False
-            auth_stage = None
-            mail_from = ""
-            rcpt_to = []
+            buffer = SMTPLineBuffer()
             
-            while True:
+            while self.running and not session.closing:
                 try:
-                    sock.settimeout(30)
-                    data = sock.recv(4096)
-                    
-                    if not data:
-                        break
+                    responses, finished = self.handle_input(session, buffer)
                     
-                    try:
-                        command = data.decode('utf-8', errors='ignore').strip()
-                    except:
-                        command = str(data, errors='ignore').strip()
+                    if finished:
+                        # Запис у чергу на диску виконуємо поза циклом подій
+                        responses.append(await asyncio.get_running_loop().run_in_executor(
+                            None, self.finish_data, session
+                        ))
                     
-                    if not command:
-                        continue
+                    if responses:
+                        await self.async_send_response(writer, "\r\n".join(responses))
                     
-                    if in_data_mode:
-                        lines = command.split('\n')
-                        for line in lines:
-                            line = line.strip('\r')
-                            if line == ".":
-                                in_data_mode = False
-                                try:
-                                    self.send_response(sock, "250 2.0.0 Повідомлення прийнято для доставки")
-                                    self.process_email(email_data, mail_from, rcpt_to)
-                                    email_data = ""
-                                    mail_from = ""
-                                    rcpt_to = []
-                                except Exception as e:
-                                    self.send_response(sock, "450 4.0.0 Тимчасова помилка")
-                                break
-                            else:
-                                email_data += line + "\n"
+                    if finished or session.closing:
                         continue
                     
-                    cmd_parts = command.split()
-                    cmd = cmd_parts[0].upper() if cmd_parts else ""
-                    
-                    if cmd == "HELO":
-                        hostname = cmd_parts[1] if len(cmd_parts) > 1 else "невідомий"
-                        self.send_response(sock, f"250 localhost Привіт {hostname}")
-                        
-                    elif cmd == "EHLO":
-                        hostname = cmd_parts[1] if len(cmd_parts) > 1 else "невідомий"
-                        responses = [
-                            f"250-localhost Привіт {hostname}",
-                            "250-AUTH LOGIN PLAIN",
-                            "250-8BITMIME", 
-                            "250-SIZE 52428800",
-                            "250 HELP"
-                        ]
-                        self.send_response(sock, "\r\n".join(responses))
-                        
-                    elif cmd == "AUTH":
-                        auth_type = cmd_parts[1].upper() if len(cmd_parts) > 1 else "LOGIN"
-                        
-                        if auth_type == "LOGIN":
-                            auth_stage = "username"
-                            self.send_response(sock, "334 VXNlcm5hbWU6")
-                        elif auth_type == "PLAIN":
-                            if len(cmd_parts) > 2:
-                                self.send_response(sock, "235 2.7.0 Автентифікація успішна")
-                            else:
-                                self.send_response(sock, "334 ")
-                        else:
-                            self.send_response(sock, "235 2.7.0 Автентифікація успішна")
-                            
-                    elif auth_stage == "username":
-                        auth_stage = "password"
-                        self.send_response(sock, "334 UGFzc3dvcmQ6")
-                        
-                    elif auth_stage == "password":
-                        auth_stage = None
-                        self.send_response(sock, "235 2.7.0 Автентифікація успішна")
-                        
-                    elif cmd == "MAIL":
-                        if "FROM:" in command.upper():
-                            mail_from = command.split("FROM:", 1)[1].strip().strip("<>")
-                        self.send_response(sock, "250 2.1.0 Добре")
-                        
-                    elif cmd == "RCPT":
-                        if "TO:" in command.upper():
-                            rcpt = command.split("TO:", 1)[1].strip().strip("<>")
-                            rcpt_to.append(rcpt)
-                        self.send_response(sock, "250 2.1.5 Добре")
-                        
-                    elif cmd == "DATA":
-                        self.send_response(sock, "354 Закінчіть дані з <CR><LF>.<CR><LF>")
-                        in_data_mode = True
-                        email_data = ""
-                        
-                    elif cmd == "QUIT":
-                        self.send_response(sock, "221 2.0.0 До побачення")
+                    data = await asyncio.wait_for(reader.read(65536), timeout=30)
+                    if not data:
                         break
+                    buffer.feed(data)
                         
-                    elif cmd == "RSET":
-                        email_data = ""
-                        mail_from = ""
-                        rcpt_to = []
-                        in_data_mode = False
-                        auth_stage = None
-                        self.send_response(sock, "250 2.0.0 Добре")
-                        
-                    elif cmd == "NOOP":
-                        self.send_response(sock, "250 2.0.0 Добре")
-                        
-                    elif cmd == "HELP":
-                        self.send_response(sock, "214 2.0.0 Допомога доступна")
-                        
-                    else:
-                        self.send_response(sock, "250 2.0.0 Добре")
-                        
-                except socket.timeout:
+                except asyncio.TimeoutError:
                     break
-                except socket.error as e:
+                except ConnectionError:
                     break
                 except Exception as e:
                     try:
-                        self.send_response(sock, "500 5.0.0 Помилка команди")
+                        await self.async_send_response(writer, "500 5.0.0 Помилка команди")
                     except:
                         pass
                     
         except Exception as e:
             pass
+        finally:
+            session.reset()
+            self.release_session(started)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+    
+    async def async_send_response(self, writer, response):
+        """Відправка відповіді клієнту (asyncio)"""
+        writer.write((response + "\r\n").encode('utf-8'))
+        await writer.drain()
     
     def send_response(self, sock, response):
         """Відправка відповіді клієнту"""
@@ -221,352 +2762,420 @@ class FakeSSLSMTPServer:
         except Exception as e:
             pass
     
-    def process_email(self, email_data, mail_from, rcpt_to):
-        """Обробка отриманого листа"""
+    def run_pipeline(self, report, skip=()):
+        """Послідовний запуск етапів обробки з вимірюванням часу кожного"""
+        for stage in self.PIPELINE_STAGES:
+            if stage in skip or report.empty or report.duplicate:
+                continue
+            started = time.perf_counter()
+            getattr(self, "stage_" + stage)(report)
+            report.timings[stage] = elapsed = time.perf_counter() - started
+            METRICS.observe("report_stage_duration_seconds", elapsed, stage=stage)
+    
+    def stage_parse(self, report):
+        """Етап parse: розбір MIME (великий лист читається прямо з файлу)"""
+        if report.is_empty():
+            report.empty = True
+            return
+        if report.msg is not None:
+            return
         try:
-            if not email_data.strip():
-                return
-            
-            try:
-                msg = email.message_from_string(email_data)
-                subject = self.decode_header(msg.get('Subject', 'Без теми'))
-                sender = self.decode_header(msg.get('From', mail_from or 'Невідомий відправник'))
-                
-                body = self.extract_body(msg)
-                
-                self.send_to_telegram(subject, sender, body)
-                
-            except Exception as e:
-                self.send_to_telegram("Необроблені дані листа", mail_from or "невідомо", email_data[:3000])
-            
+            # Розбір прямо з байтів: 8-бітні тіла (8BITMIME) не псуються декодуванням.
+            # Лист понад message_parse_limit читається з файлу частинами, але дерево MIME будується в пам'яті цілком
+            parser = BytesParser(policy=policy.default)
+            if report.path:
+                with open(report.path, 'rb') as f:
+                    report.msg = parser.parse(f)
+            else:
+                report.msg = parser.parsebytes(report.data)
         except Exception as e:
-            pass
+            report.parse_error = e
     
-    def decode_header(self, header_value):
-        """Декодування заголовків email"""
-        if not header_value:
-            return ""
+    def stage_extract(self, report):
+        """Етап extract: тема, відправник та тіло листа"""
+        if report.body is not None:
+            return
+        if report.parse_error is None:
+            try:
+                report.subject = report.header('Subject', 'Без теми')
+                report.sender = report.header('From', report.mail_from or 'Невідомий відправник')
+                # Кодування запам'ятовується для кожної каси (адреси відправника)
+                report.body = self.extract_body(report.msg, report.mail_from or report.sender)
+                report.attachments, report.skipped_attachments = self.extract_attachments(report.msg)
+                return
+            except Exception as e:
+                report.parse_error = e
         
+        # Лист не вдалося розібрати - відправляємо початок сирих даних
+        report.subject = "Необроблені дані листа"
+        report.sender = report.mail_from or "невідомо"
+        report.body = report.raw_head(3000)
+    
+    def stage_normalize(self, report):
+        """Етап normalize: HTML -> текст з Markdown розміткою"""
+        if report.text is None:
+            report.text = HtmlToText().convert(report.body) if report.body else ""
+    
+    def stage_dedup(self, report):
+        """Етап dedup: хеш вмісту звіту та відкидання звіту, який каса надіслала повторно (не отримавши 250)"""
+        text = " ".join(report.text.split())
+        files = "\0".join([f"{document.filename}:{document.size}" for document in report.attachments]
+                          + report.skipped_attachments)
+        key = f"{report.mail_from}\0{report.subject}\0{text}\0{files}".encode('utf-8', errors='surrogatepass')
+        report.digest = hashlib.sha256(key).hexdigest()
+        if self.dedup is None:
+            return
+        owner = report.delivery[0] if report.delivery else None
+        report.duplicate = self.dedup.check(report.digest, owner)
+        if report.duplicate:
+            METRICS.inc("reports_total", result="duplicate")
+    
+    def stage_format(self, report):
+        """Етап format: оформлення звітів SAMPO"""
+        if report.formatted is None:
+            formatted = self.format_sampo_report(report.text).strip()
+            report.formatted = formatted or "Порожній вміст листа"
+    
+    def stage_store(self, report):
+        """Етап store: підсумки та товари звіту в базу історії продажів і денні підсумки"""
+        if report.figures is not None:
+            return
+        report_format = self.report_format(report.text)
+        if report_format is None or not report_format.FIELDS:
+            return
+        report.figures = report_format.parse(report.text)
+        if self.aggregates is not None:
+            self.aggregates.add(report.figures, report.digest)
+        if self.reports is None:
+            return
         try:
-            from email.header import decode_header
-            decoded = decode_header(header_value)
-            result = ""
-            
-            for part, encoding in decoded:
-                if isinstance(part, bytes):
-                    if encoding:
-                        result += part.decode(encoding, errors='ignore')
-                    else:
-                        result += part.decode('utf-8', errors='ignore')
-                else:
-                    result += str(part)
-            
-            return result
+            self.reports.add(
+                report.figures,
+                report.mail_from or report.sender,
+                report.subject,
+                digest=report.digest,
+                spool_id=report.delivery[0] if report.delivery else None
+            )
         except Exception as e:
-            return str(header_value)
+            # Збій бази історії не затримує доставку звіту
+            METRICS.inc("errors_total", where="store")
     
-    def extract_body(self, msg):
-        """Витягування тіла листа з обробкою HTML та кодувань"""
-        try:
-            body_text = ""
-            
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    if content_type in ["text/plain", "text/html"]:
-                        charset = part.get_content_charset() or 'utf-8'
-                        payload = part.get_payload(decode=True)
-                        if isinstance(payload, bytes):
-                            for encoding in [charset, 'windows-1251', 'utf-8', 'cp1251']:
-                                try:
-                                    body_text = payload.decode(encoding, errors='ignore')
-                                    break
-                                except:
-                                    continue
-                        else:
-                            body_text = str(payload)
-                        break
+    def stage_split(self, report):
+        """Етап split: заголовок та розбиття на повідомлення Telegram (або один файл)"""
+        if report.messages is not None:
+            return
+        if report.skipped_attachments:
+            report.formatted += "\n\n" + "\n".join(report.skipped_attachments)
+        report.messages = self.build_messages(report.subject, report.sender, report.formatted)
+        if self.document_threshold and len(report.messages) > self.document_threshold:
+            report.document = self.build_document(report)
+            header = self.report_header(report.subject, report.sender)
+            report.messages = [header + "📎 Повний звіт у вкладеному файлі", report.document]
+        # Вкладення: по одному - sendDocument, кілька - альбомами до 10 файлів (sendMediaGroup)
+        for i in range(0, len(report.attachments), MEDIA_GROUP_LIMIT):
+            group = report.attachments[i:i + MEDIA_GROUP_LIMIT]
+            report.messages.append(group if len(group) > 1 else group[0])
+    
+    def build_document(self, report):
+        """Повний звіт одним файлом: відформатований текст або CSV з рядків таблиць"""
+        name = "report_" + datetime.now().strftime('%Y%m%d_%H%M%S')
+        report_format = self.report_format(report.text)
+        if self.document_format == 'csv' and report_format:
+            text = report.text
+            return TelegramDocument.from_rows(name + ".csv", lambda: report_format.table_rows(text))
+        return TelegramDocument.from_text(name + ".txt", report.formatted)
+    
+    def stage_deliver(self, report):
+        """Етап deliver: звіт стає в черги чатів маршруту (або додається до зведення)"""
+        for destination in self.router.route(report.rcpt_to, report.mail_from, report.subject):
+            if self.destination_key(destination) in report.delivered:
+                continue
+            window = self.digest_window_for(destination[1])
+            # Звіт-файл та звіт з вкладеннями у зведення не об'єднуються
+            if window > 0 and report.document is None and not report.attachments:
+                self.add_to_digest(destination, report, window)
             else:
-                charset = msg.get_content_charset() or 'utf-8'
-                payload = msg.get_payload(decode=True)
-                if isinstance(payload, bytes):
-                    for encoding in [charset, 'windows-1251', 'utf-8', 'cp1251']:
-                        try:
-                            body_text = payload.decode(encoding, errors='ignore')
-                            break
-                        except:
-                            continue
-                else:
-                    body_text = str(payload)
-            
-            body_text = self.clean_html(body_text)
-            
-            return body_text if body_text.strip() else "Порожній вміст листа"
-            
-        except Exception as e:
-            pass
-        
-        return "Не вдалося витягти вміст листа"
+                with self.digest_lock:
+                    report.pending += 1
+                self.schedule(destination, report.messages, [report])
     
-    def clean_html(self, html_text):
-        """Очищення HTML тегів та форматування"""
-        if not html_text:
-            return ""
-        
-        # Заміна HTML таблиць на читабельний формат
-        html_text = re.sub(r'<caption[^>]*>(.*?)</caption>', r'\n**\1**\n', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'<tr[^>]*>', '\n', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</tr>', '', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'<td[^>]*>', ' ', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</td>', ' |', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'<th[^>]*>', ' **', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</th>', '** |', html_text, flags=re.IGNORECASE)
-        
-        # Заміна заголовків
-        html_text = re.sub(r'<h[1-6][^>]*>', '\n**', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</h[1-6]>', '**\n', html_text, flags=re.IGNORECASE)
-        
-        # Заміна параграфів
-        html_text = re.sub(r'<p[^>]*>', '\n', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</p>', '\n', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'<br[^>]*/?>', '\n', html_text, flags=re.IGNORECASE)
-        
-        # Заміна жирного тексту
-        html_text = re.sub(r'<b[^>]*>', '**', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</b>', '**', html_text, flags=re.IGNORECASE)
-        
-        # Заміна кольорового тексту
-        html_text = re.sub(r'<font[^>]*color[^>]*>', '*', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</font>', '*', html_text, flags=re.IGNORECASE)
-        
-        # Видалення всіх інших HTML тегів
-        html_text = re.sub(r'<[^>]+>', '', html_text)
-        
-        # Декодування HTML entities
-        html_text = html_text.replace('&nbsp;', ' ')
-        html_text = html_text.replace('&amp;', '&')
-        html_text = html_text.replace('&lt;', '<')
-        html_text = html_text.replace('&gt;', '>')
-        html_text = html_text.replace('&quot;', '"')
-        
-        # Очищення зайвих символів та покращене форматування
-        html_text = re.sub(r' +', ' ', html_text)
-        html_text = re.sub(r'\n\s*\n', '\n', html_text)
-        html_text = re.sub(r' *\| *\|', ' |', html_text)
-        
-        # Покращення форматування для SAMPO звітів
-        formatted_text = self.format_sampo_report(html_text)
+    @staticmethod
+    def destination_key(destination):
+        """Ідентифікатор чату для черги: id бота та chat_id (без секретної частини токена)"""
+        token, chat_id = destination
+        return f"{token.split(':')[0]}:{chat_id}"
+    
+    def schedule(self, destination, messages, reports):
+        """Відправка через чергу чату; після неї звіти завершуються або плануються на повтор"""
+        def done(error):
+            if error is None:
+                key = self.destination_key(destination)
+                for report in reports:
+                    report.delivered.add(key)
+                    self.spool.mark_delivered(report.delivery[0], key)
+            for report in reports:
+                self.release_report(report, error)
         
-        return formatted_text.strip()
+        # Окремий звіт при повторі продовжується з частини, на якій зупинилась попередня спроба
+        self.scheduler.submit(destination, messages, done, reports[0] if len(reports) == 1 else None)
     
-    def format_sampo_report(self, text):
-        """Спеціальне форматування для звітів SAMPO"""
-        # Перевіряємо чи це SAMPO або Unipro звіт
-        if 'SAMPO Reports' not in text and 'Unipro Reports' not in text:
-            return text
-            
-        lines = text.split('\n')
-        formatted_lines = []
-        in_table = False
+    def deliver_to(self, destination, messages, report=None):
+        """Повідомлення звіту в один чат по порядку, по одному за крок (генератор для ChatDeliveryScheduler).
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # Основна назва
-            if 'SAMPO Reports' in line or 'Unipro Reports' in line:
-                formatted_lines.append("🏪 **SAMPO REPORTS**")
-                continue
-            elif line == 'Отправка по команде пользователя.':
-                formatted_lines.append("📤 Відправка по команді користувача")
-                continue
-                
-            # Фільтр секція
-            if line == 'Фильтр':
-                formatted_lines.append("\n🔍 **ФІЛЬТР**")
-                continue
-            elif line.startswith('Организации:'):
-                org_name = line.replace('Организации:', '').strip()
-                formatted_lines.append(f"🏢 **Organisacija:** {org_name}")
-                continue
-            elif line.startswith('Склады:'):
-                warehouse = line.replace('Склады:', '').strip()
-                formatted_lines.append(f"🏪 **Склад:** {warehouse}")
-                continue
-                
-            # Зведений звіт
-            if line == 'Сводный отчет':
-                formatted_lines.append(f"\n📊 **ЗВЕДЕНИЙ ЗВІТ**")
-                continue
-            elif line.startswith('Период:'):
-                period = line.replace('Период:', '').strip()
-                formatted_lines.append(f"🗓 **Період:** {period}")
-                continue
-                
-            # Продажі та повернення секції (з caption)
-            if line == 'ПРОДАЖИ':
-                formatted_lines.append(f"\n💰 **ПРОДАЖІ**")
-                continue
-            elif line == 'ВОЗВРАТЫ':
-                formatted_lines.append(f"\n📉 **ПОВЕРНЕННЯ**")
+        Видає 0 після кожної відправленої частини або паузу в секундах, якщо чат ще не можна
+        відправляти (ліміт Telegram чи 429); для звіту з черги вже відправлені частини пропускаються.
+        """
+        total = len(messages)
+        messages = list(messages)
+        i = 0
+        key = self.destination_key(destination)
+        if report is not None:
+            sent, sent_total = report.progress.get(key, (0, total))
+            # Якщо звіт розбився інакше, ніж у попередній спробі, відправляємо його повністю
+            if sent_total == total:
+                i = sent
+        client = self.telegram_client(destination[0])
+        floods = 0
+        while i < total:
+            delay = client.limiter.delay(destination[1])
+            if delay > 0:
+                yield delay
                 continue
-                
-            # Обробка рядків з даними (формат "Ключ | Значення |")
-            if '|' in line and line.count('|') >= 2:
-                parts = [p.strip() for p in line.split('|')]
-                if len(parts) >= 3 and parts[0] and parts[1]:
-                    key = parts[0]
-                    value = parts[1]
-                    
-                    # Перевіряємо чи це не заголовок таблиці товарів
-                    if key == '№' and 'Имя' in value:
-                        formatted_lines.append(f"\n🛒 **ЗВІТ ПО ТОВАРАХ**")
-                        formatted_lines.append("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-                        formatted_lines.append("📋 **СПИСОК ТОВАРІВ:**")
-                        formatted_lines.append("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-                        in_table = True
-                        continue
-                    
-                    # Рядки товарів в таблиці
-                    if in_table and key.isdigit():
-                        num = key
-                        name = parts[1] if len(parts) > 1 else "—"
-                        qty = parts[2] if len(parts) > 2 else "—"
-                        cost = parts[3] if len(parts) > 3 else "—"
-                        profit = parts[4] if len(parts) > 4 else "—"
-                        
-                        # Скорочуємо назву якщо дуже довга
-                        if len(name) > 35:
-                            name = name[:32] + "..."
-                            
-                        formatted_lines.append(f"\n`{num:>2}.` **{name}**")
-                        formatted_lines.append(f"   📦 Кількість: `{qty}`")
-                        formatted_lines.append(f"   💵 Вартість: `{cost}`")
-                        formatted_lines.append(f"   📈 Прибуток: `{profit}`")
-                        formatted_lines.append("   ────────────────────────────")
-                        continue
-                    
-                    # Звичайні дані (Сумма, Скидка, тощо)
-                    if any(word in key.lower() for word in ['сумма', 'сума']):
-                        formatted_lines.append(f"💵 **{key}:** `{value}`")
-                    elif any(word in key.lower() for word in ['скидка', 'знижка']):
-                        formatted_lines.append(f"🏷️ **{key}:** `{value}`")
-                    elif any(word in key.lower() for word in ['прибыль', 'прибуток']):
-                        formatted_lines.append(f"📈 **{key}:** `{value}`")
-                    elif any(word in key.lower() for word in ['средний', 'середній']):
-                        formatted_lines.append(f"🧾 **{key}:** `{value}`")
-                    elif any(word in key.lower() for word in ['к-во', 'к-сть', 'чеков', 'чеків']):
-                        formatted_lines.append(f"🧾 **{key}:** `{value}`")
-                    elif any(word in key.lower() for word in ['убыток', 'збиток']):
-                        formatted_lines.append(f"📉 **{key}:** `{value}`")
-                    else:
-                        formatted_lines.append(f"📊 **{key}:** `{value}`")
+            message = messages[i]
+            try:
+                if isinstance(message, TelegramDocument):
+                    self.send_telegram_document(message, destination)
+                elif isinstance(message, list):
+                    self.send_telegram_media_group(message, destination)
+                else:
+                    self.send_telegram_message(message, i + 1, total, destination)
+            except TelegramDeliveryError as e:
+                if e.flood and floods < client.max_flood_retries:
+                    # Пауза чату вже в лімітах; частина буде відправлена після неї
+                    floods += 1
                     continue
-                    
-            # Звіт по товарах заголовок
-            if line == 'Отчет по товарам':
-                # Не додаємо тут, тому що він буде доданий коли побачимо заголовок таблиці
+                # Вкладення, яке Telegram відхилив, не повинно відправляти в недоставлені вже надісланий текст
+                if not (e.permanent and report is not None and isinstance(message, (TelegramDocument, list))
+                        and message is not report.document):
+                    raise
+                METRICS.inc("errors_total", where="attachment")
+                documents = message if isinstance(message, list) else [message]
+                names = ", ".join(self.file_label(document) for document in documents)
+                messages[i] = f"⚠️ Не вдалося надіслати файл {names}"
                 continue
-                
-            # Інші рядки без змін
-            if line not in ['', ' ']:
-                formatted_lines.append(line)
+            floods = 0
+            i += 1
+            if report is not None:
+                report.progress[key] = [i, total]
+                self.spool.mark_progress(report.delivery[0], key, i, total)
+            yield 0
+    
+    def digest_window_for(self, chat_id):
+        """Вікно зведення для чату в секундах"""
+        return float(self.digest_chats.get(str(chat_id), self.digest_window) or 0)
+    
+    def add_to_digest(self, destination, report, window):
+        """Звіт чекає у зведенні; перший звіт запускає таймер вікна"""
+        with self.digest_lock:
+            report.pending += 1
+            batch = self.digests.get(destination)
+            if batch is None:
+                batch = self.digests[destination] = []
+                timer = threading.Timer(window, self.flush_digest, (destination,))
+                timer.daemon = True
+                timer.start()
+            batch.append(report)
+    
+    def flush_digest(self, destination):
+        """Відправка зведення за вікно; звіти в черзі завершуються або плануються на повтор"""
+        with self.digest_lock:
+            reports = self.digests.pop(destination, [])
+        if not reports:
+            return
         
-        return '\n'.join(formatted_lines)
+        try:
+            if len(reports) == 1:
+                messages = reports[0].messages
+            else:
+                messages = self.build_digest_messages(reports)
+        except Exception as e:
+            for report in reports:
+                self.release_report(report, e)
+            return
+        self.schedule(destination, messages, reports)
     
-    def send_to_telegram(self, subject, sender, body):
-        """Відправка в Telegram з розбиттям на частини"""
+    def extract_body(self, msg, sender=None):
+        """Витягування тіла листа з визначенням кодування (HTML очищається на етапі normalize)"""
         try:
-            clean_body = self.clean_html(body)
-            
-            header = "📊 **ЗВІТ SAMPO**\n\n"
-            header += f"👤 **Від:** {sender}\n"
-            header += f"📧 **Тема:** {subject}\n"
-            header += f"⏰ **Час:** {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
-            header += "═" * 40 + "\n\n"
+            part = msg
+            if msg.is_multipart():
+                part = None
+                for candidate in msg.walk():
+                    if candidate.get_content_type() in ["text/plain", "text/html"] and not self.is_attachment(candidate):
+                        part = candidate
+                        break
+                if part is None:
+                    return ""
             
-            max_length = 3000
-            header_length = len(header)
-            available_length = max_length - header_length
+            payload = part.get_payload(decode=True)
+            if isinstance(payload, bytes):
+                return self.charsets.decode(payload, part.get_content_charset(), sender)
+            return str(payload)
             
-            if len(clean_body) <= available_length:
-                message = header + clean_body
-                self.send_telegram_message(message, 1, 1)
-            else:
-                parts = self.split_message(clean_body, available_length)
-                
-                first_message = header + parts[0]
-                if len(parts) > 1:
-                    first_message += f"\n\n*[Частина 1 з {len(parts)}]*"
-                
-                self.send_telegram_message(first_message, 1, len(parts))
-                
-                for i, part in enumerate(parts[1:], 2):
-                    part_message = f"*[Частина {i} з {len(parts)}]*\n\n{part}"
-                    self.send_telegram_message(part_message, i, len(parts))
-                
         except Exception as e:
             pass
-    
-    def split_message(self, text, max_length):
-        """Розбиття довгого тексту на частини"""
-        if len(text) <= max_length:
-            return [text]
         
-        parts = []
-        current_part = ""
+        return "Не вдалося витягти вміст листа"
+    
+    @staticmethod
+    def is_attachment(part):
+        """Частина листа є файлом (PDF, XLSX тощо), а не текстом звіту"""
+        return part.get_content_disposition() == 'attachment' or (
+            part.get_filename() is not None and part.get_content_maintype() != 'text'
+        )
+    
+    def extract_attachments(self, msg):
+        """Вкладення листа для пересилання в Telegram та примітки про пропущені файли"""
+        attachments = []
+        skipped = []
+        if not msg.is_multipart():
+            return attachments, skipped
+        for part in msg.walk():
+            if part.is_multipart() or not self.is_attachment(part):
+                continue
+            try:
+                filename = part.get_filename() or f"attachment{len(attachments) + len(skipped) + 1}"
+                document = TelegramDocument.from_mime_part(part, filename)
+                # Порожній файл Telegram відхиляє (400), завеликий - 413; перевіряємо заздалегідь
+                if document.size == 0:
+                    skipped.append(f"⚠️ Файл {self.file_label(document)} порожній і не надсилається")
+                elif document.size > TELEGRAM_FILE_LIMIT:
+                    skipped.append(f"⚠️ Файл {self.file_label(document)} більший за 50 МБ і не надсилається")
+                else:
+                    attachments.append(document)
+            except Exception:
+                pass
+        return attachments, skipped
+    
+    @staticmethod
+    def file_label(document):
+        """Назва файлу для тексту повідомлення (у `...`, щоб не ламати розмітку Markdown)"""
+        return "`" + document.filename.replace("`", "'") + "`"
+    
+    def report_format(self, text):
+        """Зареєстрований тип звіту для тексту або None"""
+        for report_format in REPORT_FORMATS:
+            if report_format.matches(text):
+                return report_format
+        return None
+    
+    def format_sampo_report(self, text):
+        """Спеціальне форматування для звітів SAMPO (та інших зареєстрованих типів звітів)"""
+        report_format = self.report_format(text)
+        return report_format.format(text) if report_format else text
+    
+    def build_messages(self, subject, sender, clean_body):
+        """Заголовок звіту та розбиття вже очищеного тексту на повідомлення"""
+        return self.paginate(self.report_header(subject, sender), clean_body)
+    
+    def report_header(self, subject, sender):
+        header = "📊 **ЗВІТ SAMPO**\n\n"
+        header += f"👤 **Від:** {sender}\n"
+        header += f"📧 **Тема:** {subject}\n"
+        header += f"⏰ **Час:** {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
+        header += "═" * 40 + "\n\n"
+        return header
+    
+    def build_digest_messages(self, reports):
+        """Один текст зі звітів за вікно зведення, розбитий на найменшу кількість повідомлень"""
+        header = f"📊 **ЗВЕДЕННЯ ЗВІТІВ SAMPO ({len(reports)})**\n\n"
+        header += f"⏰ **Час:** {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
+        header += "═" * 40 + "\n\n"
         
-        lines = text.split('\n')
+        sections = [
+            f"👤 **Від:** {report.sender}\n📧 **Тема:** {report.subject}\n\n{report.formatted}"
+            for report in reports
+        ]
+        return self.paginate(header, ("\n\n" + "─" * 40 + "\n\n").join(sections))
+    
+    def paginate(self, header, clean_body):
+        """Заголовок + текст, розбитий на повідомлення з позначками частин"""
+        if utf16_len(header) + utf16_len(clean_body) <= TELEGRAM_MESSAGE_LIMIT:
+            return [header + clean_body]
         
-        for line in lines:
-            if len(current_part) + len(line) + 1 > max_length:
-                if current_part:
-                    parts.append(current_part.strip())
-                    current_part = line
-                else:
-                    while len(line) > max_length:
-                        parts.append(line[:max_length].strip())
-                        line = line[max_length:]
-                    current_part = line
-            else:
-                if current_part:
-                    current_part += '\n' + line
-                else:
-                    current_part = line
+        # Запас на позначку частини з тризначними номерами
+        max_length = TELEGRAM_MESSAGE_LIMIT - utf16_len("\n\n*[Частина 999 з 999]*")
+        parts = self.split_message(clean_body, max_length, max_length - utf16_len(header))
         
-        if current_part:
-            parts.append(current_part.strip())
+        first_message = header + parts[0]
+        if len(parts) > 1:
+            first_message += f"\n\n*[Частина 1 з {len(parts)}]*"
         
-        return parts
+        messages = [first_message]
+        for i, part in enumerate(parts[1:], 2):
+            messages.append(f"*[Частина {i} з {len(parts)}]*\n\n{part}")
+        return messages
     
-    def send_telegram_message(self, message, part_num, total_parts):
-        """Відправка одного повідомлення в Telegram"""
-        try:
-            url = f"https://api.telegram.org/bot{self.token}/sendMessage"
-            payload = {
-                'chat_id': self.chat_id,
-                'text': message,
-                'parse_mode': 'Markdown'
-            }
-            
-            response = requests.post(url, data=payload, timeout=30)
-            
-            if part_num < total_parts:
-                import time
-                time.sleep(0.5)
-                
-        except Exception as e:
-            pass
+    def split_message(self, text, max_length, first_length=None):
+        """Розбиття довгого тексту на частини (довжина в одиницях UTF-16, як у Telegram)"""
+        if utf16_len(text) <= (first_length or max_length):
+            return [text]
+        return MarkdownSplitter().split(text, max_length, first_length)
+    
+    def send_telegram_message(self, message, part_num, total_parts, destination=None):
+        """Відправка одного повідомлення в Telegram (за замовчуванням - в основний чат)"""
+        token, chat_id = destination or (self.token, self.chat_id)
+        # Темп відправки задає TelegramRateLimiter (паузи чекає ChatDeliveryScheduler, а не потік)
+        response = self.telegram_client(token).send_message(chat_id, message, parse_mode='Markdown', wait=False)
+        self.check_response(response)
+    
+    def send_telegram_document(self, document, destination=None):
+        """Відправка файлу в Telegram"""
+        token, chat_id = destination or (self.token, self.chat_id)
+        self.check_response(self.telegram_client(token).send_document(chat_id, document, wait=False))
+    
+    def send_telegram_media_group(self, documents, destination=None):
+        """Відправка кількох файлів одним альбомом"""
+        token, chat_id = destination or (self.token, self.chat_id)
+        self.check_response(self.telegram_client(token).send_media_group(chat_id, documents, wait=False))
+    
+    def telegram_client(self, token):
+        """Клієнт бота: основний або спільний клієнт іншого токена з маршрутів"""
+        return self.telegram if token == self.token else get_telegram_client(token, **self.telegram_options)
+    
+    def check_response(self, response):
+        """Помилка доставки, якщо Telegram не прийняв запит"""
+        if response.status_code != 200:
+            raise TelegramDeliveryError(
+                f"HTTP {response.status_code}: {response.text[:200]}",
+                # 413 - файл завеликий для Bot API
+                permanent=response.status_code in (400, 401, 403, 404, 413),
+                flood=response.status_code == 429
+            )
     
     def stop(self):
         """Зупинка сервера"""
         self.running = False
+        if self.loop and self.stop_event:
+            try:
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+            except RuntimeError:
+                pass
         if self.server_socket:
             try:
                 self.server_socket.close()
             except:
                 pass
+        if self.spool:
+            self.spool.wakeup()
+        if self.session_pool:
+            self.session_pool.shutdown(wait=False)
+        self.summary_event.set()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        self.scheduler.shutdown()
 
 class SMTPBridgeApp:
     def __init__(self):
@@ -591,6 +3200,36 @@ class SMTPBridgeApp:
             "telegram_chat_id": "",
             "smtp_host": "localhost", 
             "smtp_port": 25,
+            "smtp_engine": "asyncio",
+            "processing_workers": 4,
+            "max_sessions": 100,
+            "listen_backlog": 128,
+            "http_pool_size": 8,
+            "http_connect_timeout": 5,
+            "http_read_timeout": 30,
+            "telegram_global_rate": 30,
+            "telegram_chat_rate": 1.0,
+            "telegram_group_rate_per_minute": 20,
+            "retry_max_attempts": 8,
+            "retry_base_delay": 5,
+            "retry_max_delay": 600,
+            "max_message_size": 52428800,
+            "message_memory_limit": 1048576,
+            "message_parse_limit": 10485760,
+            "digest_window": 0,
+            "digest_chats": {},
+            "dedup_window": 600,
+            "dedup_cache_size": 1024,
+            "dedup_persist": True,
+            "routes": [],
+            "fanout_workers": 8,
+            "document_threshold": 0,
+            "document_format": "text",
+            "reports_path": REPORTS_FILE,
+            "daily_summary_time": "",
+            "daily_summary_chat": "",
+            "checkpoint_interval": 60,
+            "metrics_port": 0,
             "auto_start": True
         }
         
@@ -681,6 +3320,7 @@ class SMTPBridgeApp:
         
         ttk.Button(buttons_frame, text="Зберегти", command=self.save_settings).pack(side=tk.LEFT, padx=5)
         ttk.Button(buttons_frame, text="Тест Telegram", command=self.test_telegram).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons_frame, text="Повторити недоставлені", command=self.replay_dead_letters).pack(side=tk.LEFT, padx=5)
         
         # Кнопки роботи з трей та автозавантаженням
         tray_buttons_frame = ttk.Frame(self.root)
@@ -703,6 +3343,17 @@ class SMTPBridgeApp:
         self.port_var.set(str(self.config["smtp_port"]))
         self.auto_start_var.set(self.config.get("auto_start", True))
     
+    def telegram_options(self):
+        """Параметри HTTP клієнта та лімітів Telegram з конфігурації"""
+        return {
+            "pool_size": self.config["http_pool_size"],
+            "connect_timeout": self.config["http_connect_timeout"],
+            "read_timeout": self.config["http_read_timeout"],
+            "global_rate": self.config["telegram_global_rate"],
+            "chat_rate": self.config["telegram_chat_rate"],
+            "group_rate": self.config["telegram_group_rate_per_minute"] / 60
+        }
+    
     def start_server(self):
         """Запуск сервера"""
         if not self.config["telegram_token"] or not self.config["telegram_chat_id"]:
@@ -716,7 +3367,32 @@ class SMTPBridgeApp:
                 host=self.config["smtp_host"],
                 port=port,
                 token=self.config["telegram_token"],
-                chat_id=self.config["telegram_chat_id"]
+                chat_id=self.config["telegram_chat_id"],
+                engine=self.config["smtp_engine"],
+                processing_workers=self.config["processing_workers"],
+                max_sessions=self.config["max_sessions"],
+                listen_backlog=self.config["listen_backlog"],
+                telegram_options=self.telegram_options(),
+                retry_max_attempts=self.config["retry_max_attempts"],
+                retry_base_delay=self.config["retry_base_delay"],
+                retry_max_delay=self.config["retry_max_delay"],
+                max_message_size=self.config["max_message_size"],
+                message_memory_limit=self.config["message_memory_limit"],
+                message_parse_limit=self.config["message_parse_limit"],
+                digest_window=self.config["digest_window"],
+                digest_chats=self.config["digest_chats"],
+                dedup_window=self.config["dedup_window"],
+                dedup_cache_size=self.config["dedup_cache_size"],
+                dedup_persist=self.config["dedup_persist"],
+                routes=self.config["routes"],
+                fanout_workers=self.config["fanout_workers"],
+                document_threshold=self.config["document_threshold"],
+                document_format=self.config["document_format"],
+                reports_path=self.config["reports_path"],
+                daily_summary_time=self.config["daily_summary_time"],
+                daily_summary_chat=self.config["daily_summary_chat"],
+                checkpoint_interval=self.config["checkpoint_interval"],
+                metrics_port=self.config["metrics_port"]
             )
             
             self.server_thread = threading.Thread(target=self.server.start, daemon=True)
@@ -766,16 +3442,13 @@ class SMTPBridgeApp:
             return
         
         try:
-            url = f"https://api.telegram.org/bot{token}/sendMessage"
-            payload = {
-                'chat_id': chat_id,
-                'text': f"🧪 Тестове повідомлення від SAMPO Reports\n\n"
-                       f"Час: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n\n"
-                       f"SMTP-Telegram міст готовий до роботи!\n"
-                       f"Довгі звіти будуть розбиватися на частини автоматично."
-            }
+            client = get_telegram_client(token, **self.telegram_options())
+            text = (f"🧪 Тестове повідомлення від SAMPO Reports\n\n"
+                    f"Час: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n\n"
+                    f"SMTP-Telegram міст готовий до роботи!\n"
+                    f"Довгі звіти будуть розбиватися на частини автоматично.")
             
-            response = requests.post(url, data=payload, timeout=10)
+            response = client.send_message(chat_id, text, timeout=10)
             
             if response.status_code == 200:
                 messagebox.showinfo("Успіх", "Тестове повідомлення відправлено!")
@@ -785,6 +3458,24 @@ class SMTPBridgeApp:
         except Exception as e:
             messagebox.showerror("Помилка", f"Помилка підключення: {e}")
     
+    def replay_dead_letters(self):
+        """Повторна відправка недоставлених звітів"""
+        try:
+            if self.server and self.server.spool:
+                spool = self.server.spool
+            else:
+                spool = DeliverySpool(SPOOL_FILE)
+            
+            count = spool.replay()
+            
+            if count:
+                messagebox.showinfo("Успіх", f"Повернуто в чергу звітів: {count}")
+            else:
+                messagebox.showinfo("Інформація", "Недоставлених звітів немає")
+                
+        except Exception as e:
+            messagebox.showerror("Помилка", f"Не вдалося повторити відправку: {e}")
+    
     def minimize_to_tray(self):
         """Згортання в системний трей"""
         try:
@@ -954,6 +3645,69 @@ class SMTPBridgeApp:
         """Запуск застосунку"""
         self.root.mainloop()
 
+def run_cli(args):
+    """Обробка команд командного рядка: черга недоставлених та історія продажів"""
+    spool = DeliverySpool(SPOOL_FILE)
+    
+    if args.list_dead:
+        for msg_id, received_at, mail_from, attempts, last_error in spool.dead_letters():
+            received = datetime.fromtimestamp(received_at).strftime('%d.%m.%Y %H:%M:%S')
+            print(f"{msg_id}\t{received}\t{mail_from}\tспроб: {attempts}\t{last_error}")
+    
+    if args.replay_dead is not None:
+        count = spool.replay(args.replay_dead)
+        print(f"Повернуто в чергу: {count}")
+    
+    # База історії - та сама, що задана в налаштуваннях сервера
+    reports_path = REPORTS_FILE
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                reports_path = json.load(f).get("reports_path", REPORTS_FILE)
+        except Exception:
+            pass
+    if (args.history or args.compare) and not reports_path:
+        print("Історію продажів вимкнено в налаштуваннях (reports_path)")
+        return
+    
+    if args.history:
+        since, _ = period_dates(args.history[0])
+        until, _ = period_dates(args.history[-1])
+        if since is None or until is None:
+            print("Дата має бути у форматі ДД.ММ.РРРР")
+            return
+        for day, organisation, warehouse, section, metric, value in ReportStore(reports_path).daily_totals(
+                since, until, args.warehouse):
+            print(f"{day}\t{organisation}\t{warehouse}\t{section}\t{metric}\t{value:.2f}")
+    
+    if args.compare:
+        day, _ = period_dates(args.compare[0])
+        other, _ = period_dates(args.compare[1])
+        if day is None or other is None:
+            print("Дата має бути у форматі ДД.ММ.РРРР")
+            return
+        comparison = ReportStore(reports_path).compare_days(day, other, args.warehouse)
+        for (organisation, warehouse, section, metric), (value, other_value) in sorted(
+                comparison.items(), key=lambda item: tuple(str(part) for part in item[0])):
+            print(f"{organisation}\t{warehouse}\t{section}\t{metric}\t"
+                  f"{value:.2f}\t{other_value:.2f}\t{value - other_value:+.2f}")
+
 if __name__ == "__main__":
-    app = SMTPBridgeApp()
-    app.run()
+    parser = argparse.ArgumentParser(description="SMTP-Telegram міст для касових звітів SAMPO")
+    parser.add_argument("--list-dead", action="store_true",
+                        help="показати недоставлені звіти")
+    parser.add_argument("--replay-dead", nargs="*", type=int, metavar="ID",
+                        help="повернути недоставлені звіти в чергу (усі, якщо ID не вказано)")
+    parser.add_argument("--history", nargs="+", metavar="ДАТА",
+                        help="підсумки продажів по днях за період: ДД.ММ.РРРР [ДД.ММ.РРРР]")
+    parser.add_argument("--compare", nargs=2, metavar="ДАТА",
+                        help="порівняти підсумки двох днів: ДД.ММ.РРРР ДД.ММ.РРРР")
+    parser.add_argument("--warehouse", metavar="СКЛАД",
+                        help="обмежити --history та --compare одним складом")
+    args = parser.parse_args()
+    
+    if args.list_dead or args.replay_dead is not None or args.history or args.compare:
+        run_cli(args)
+    else:
+        app = SMTPBridgeApp()
+        app.run()